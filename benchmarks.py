@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for manga. The in-memory ones measure building, validating,
+converting and reading documents of flat, nested and list-heavy models.
+The database ones need a MongoDB server running on localhost, and use (and
+drop) the _benchmarks database, or run against mongomock with --mock.
+
+    python benchmarks.py [number of documents] [--mock | --no-db]
+                         [--json results.json] [--baseline results.json]
+
+Results can be saved as JSON, and compared with those of an earlier run:
+any benchmark slower than the baseline by more than --tolerance makes the
+run exit with status 1. Each benchmark keeps the best of a few runs.
+"""
+
+# Python.
+import sys
+import json
+import argparse
+import platform
+import tracemalloc
+from time import perf_counter
+
+import manga
+from manga import (Document, Model, Field, StringField, EmailField,
+                   DateTimeField, DictField, DocumentField, ListField)
+
+
+# Results of the run, by benchmark name, as (value, unit) pairs.
+results = {}
+
+# Units where lower values are better.
+lower_is_better = ('bytes',)
+
+
+class BenchRow(Model):
+    name = StringField()
+    email = EmailField()
+    score = Field(blank=True)
+    tags = ListField(field=StringField(), blank=True)
+    bio = StringField(blank=True)
+    created = DateTimeField(auto='created')
+
+
+class BenchPoint(Document):
+    x = Field(blank=True)
+    y = Field(blank=True)
+    label = StringField(blank=True)
+
+
+class BenchShape(Model):
+    name = StringField()
+    origin = DocumentField(document=BenchPoint)
+    corner = DocumentField(document=BenchPoint)
+    style = DictField(blank=True)
+
+
+class BenchPath(Model):
+    name = StringField()
+    points = ListField(field=DocumentField(document=BenchPoint))
+    tags = ListField(field=StringField(), blank=True)
+    weights = ListField(blank=True)
+
+
+def point(x):
+    return {'x': x, 'y': x * 2, 'label': 'p%s' % x}
+
+
+def flat_data(x):
+    return {'name': 'name %s' % x, 'email': 'x%s@y.com' % x, 'score': x,
+            'tags': ['a', 'b', 'c'], 'bio': 'x' * 500}
+
+
+def nested_data(x):
+    return {'name': 'shape %s' % x, 'origin': BenchPoint(point(x)),
+            'corner': BenchPoint(point(x + 1)), 'style': {'color': 'red'}}
+
+
+def list_data(x):
+    return {'name': 'path %s' % x,
+            'points': [BenchPoint(point(i)) for i in range(20)],
+            'tags': ['t%s' % i for i in range(20)],
+            'weights': list(range(50))}
+
+
+# Representative models, with a function building the data of their rows.
+kinds = [('flat', BenchRow, flat_data), ('nested', BenchShape, nested_data),
+         ('lists', BenchPath, list_data)]
+
+
+def rate(func, count, repeat=3, prepare=None):
+    '''
+    Runs func, which handles count rows, repeat times, and returns the
+    best rate in rows per second. prepare is run before each, untimed.
+    '''
+
+    best = None
+
+    for x in range(repeat):
+        if prepare is not None:
+            prepare()
+
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return count / best
+
+
+def report(name, value, unit='rows/s'):
+    results[name] = (value, unit)
+    print('%-30s %12.0f %s' % (name, value, unit))
+
+
+def wide_model(size):
+    '''Builds a Document class with size fields of assorted types.'''
+
+    kinds = [lambda: Field(), lambda: Field(blank=True),
+             lambda: StringField(length=(1, 50)), lambda: EmailField()]
+    dct = dict(('f%s' % x, kinds[x % len(kinds)]()) for x in range(size))
+
+    return type('Wide%s' % size, (Document,), dct)
+
+
+def wide_data(size):
+    values = [1, None, 'some text', 'someone@example.com']
+
+    return dict(('f%s' % x, values[x % len(values)]) for x in range(size))
+
+
+def bench_construct(count):
+    '''Building and validating documents, compiled and generic.'''
+
+    for size in (10, 100):
+        cls = wide_model(size)
+        data = wide_data(size)
+
+        def compiled():
+            for x in range(count):
+                cls(data).validate()
+
+        def generic():
+            for x in range(count):
+                obj = cls.__new__(cls)
+                Document.__init__(obj, data)
+                Document.validate(obj)
+
+        for func in (compiled, generic):
+            name = 'construct %s fields %s' % (size, func.__name__)
+            report(name, rate(func, count))
+
+
+def bench_models(count):
+    '''
+    Building (which converts the values for storage), validating, loading
+    from stored data and reading, and setting fields of each kind of model.
+    '''
+
+    for kind, cls, make in kinds:
+        data = [make(x) for x in range(count)]
+        sons = [cls(x)._data for x in data]
+        objs = [cls(x) for x in data]
+        fields = list(cls._fields)
+
+        def construct():
+            for x in data:
+                cls(x)
+
+        def validate():
+            for x in objs:
+                x.validate()
+
+        def load():
+            for son in sons:
+                obj = cls._from_son(son)
+
+                for fname in fields:
+                    getattr(obj, fname)
+
+        def set_name():
+            for x in objs:
+                x.name = 'other name'
+
+        for func in (construct, validate, load, set_name):
+            report('%s %s' % (func.__name__, kind), rate(func, count))
+
+
+class CompactBenchRow(BenchRow):
+    _collection = 'compactbenchrow'
+    _compact = True
+
+
+def bench_memory(count):
+    '''Bytes used per loaded instance, with and without compact storage.'''
+
+    son = {'name': 'name', 'email': 'x@y.com', 'score': 1, 'tags': ['a'],
+           'bio': 'bio', 'created': None}
+
+    for cls in (BenchRow, CompactBenchRow):
+        tracemalloc.start()
+        # Every instance gets its own son, as it would coming from the db.
+        instances = [cls._from_son(dict(son)) for x in range(count)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        report('memory %s' % cls.__name__, size / len(instances), 'bytes')
+
+
+def bench_crud(count, mock=False):
+    '''
+    Inserting, reading, updating and deleting each kind of model. mongomock
+    can't store RawBSONDocuments, so saving them is skipped with mock.
+    '''
+
+    for kind, cls, make in kinds:
+        collection = cls._get_collection()
+        data = [make(x) for x in range(count)]
+        objs = []
+
+        def unsaved():
+            collection.drop()
+            objs[:] = [cls(x) for x in data]
+
+        def save():
+            for x in objs:
+                x.save()
+
+        def save_many():
+            cls.save_many(objs)
+
+        def save_many_raw():
+            cls.save_many(objs, raw=True)
+
+        def find():
+            for x in cls.find():
+                x.name
+
+        def find_one():
+            for x in objs:
+                cls.find_one(x._id)
+
+        def update():
+            for x in objs:
+                x.name = 'changed %s' % x.name[-5:]
+                x.save()
+
+        def delete():
+            for x in list(cls.find()):
+                x.delete()
+
+        saving = (save, save_many) if mock else \
+            (save, save_many, save_many_raw)
+
+        for func in saving:
+            name = '%s %s' % (func.__name__, kind)
+            report(name, rate(func, count, prepare=unsaved))
+
+        for func in (find, find_one, update):
+            report('%s %s' % (func.__name__, kind), rate(func, count))
+
+        # There is nothing left to delete after the first run.
+        report('delete %s' % kind, rate(delete, count, repeat=1))
+
+
+def bench_reads(count, mock=False):
+    '''
+    Reading rows as model instances, compared to the raw fast paths.
+    mongomock can't read RawBSONDocuments, so lazy decoding is skipped with
+    mock.
+    '''
+
+    db = manga.db
+    db.benchrow.drop()
+
+    rows = (BenchRow({'name': 'name %s' % x, 'email': 'x%s@y.com' % x,
+                      'score': x, 'tags': ['a', 'b', 'c'], 'bio': 'x' * 500})
+            for x in range(count))
+    BenchRow.save_many(rows)
+
+    def instances():
+        for x in BenchRow.find():
+            x.name, x.score
+
+    def partial_instances():
+        for x in BenchRow.find().only('name', 'score'):
+            x.name, x.score
+
+    def lazy_instances():
+        for x in BenchRow.find().lazy_decode():
+            x.name, x.score
+
+    def raw():
+        for x in BenchRow.find().as_raw():
+            x['name'], x['score']
+
+    def values():
+        for x in BenchRow.find().values('name', 'score'):
+            x['name'], x['score']
+
+    def values_list():
+        for name, score in BenchRow.find().values_list('name', 'score'):
+            pass
+
+    reads = [instances, partial_instances, raw, values, values_list]
+
+    if not mock:
+        reads.insert(2, lazy_instances)
+
+    for func in reads:
+        report('read %s' % func.__name__, rate(func, count))
+
+    db.benchrow.drop()
+
+
+def save_results(path, count, backend):
+    data = {'count': count, 'backend': backend,
+            'python': platform.python_version(), 'manga': manga.__version__,
+            'results': dict((name, {'value': value, 'unit': unit})
+                            for name, (value, unit) in results.items())}
+
+    with open(path, 'w') as stream:
+        json.dump(data, stream, indent=2, sort_keys=True)
+
+
+def compare(path, tolerance):
+    '''
+    Prints how the results compare to those saved at path, and returns the
+    names of the benchmarks that got worse by more than tolerance.
+    '''
+
+    with open(path) as stream:
+        baseline = json.load(stream)['results']
+
+    worse = []
+    print('\n%-30s %12s %12s %8s' % ('compared to ' + path, 'baseline',
+                                      'now', 'change'))
+
+    for name, (value, unit) in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['value']
+        change = value / before - 1 if before else 0.0
+
+        if unit in lower_is_better:
+            change = -change
+
+        print('%-30s %12.0f %12.0f %+7.1f%%' % (name, before, value,
+                                                 change * 100))
+
+        if change < -tolerance:
+            worse.append(name)
+
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for manga.')
+    parser.add_argument('count', type=int, nargs='?', default=10000,
+                        help='number of documents (default 10000)')
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument('--mock', action='store_true',
+                         help='run the database benchmarks on mongomock')
+    backend.add_argument('--no-db', action='store_true',
+                         help='skip the database benchmarks')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare with these results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown allowed by --baseline (default 0.2)')
+    args = parser.parse_args(argv)
+
+    bench_construct(args.count)
+    bench_models(args.count)
+    bench_memory(args.count)
+
+    if args.mock:
+        try:
+            import mongomock
+
+        except ImportError:
+            parser.error('--mock needs mongomock installed.')
+
+        manga.MongoClient = mongomock.MongoClient
+
+    if not args.no_db:
+        manga.setup('_benchmarks')
+        bench_crud(args.count, args.mock)
+        bench_reads(args.count, args.mock)
+
+    if args.json:
+        backend = 'none' if args.no_db else \
+            'mongomock' if args.mock else 'mongodb'
+        save_results(args.json, args.count, backend)
+
+    if args.baseline:
+        worse = compare(args.baseline, args.tolerance)
+
+        if worse:
+            print('\nSlower than the baseline: %s' % ', '.join(worse))
+
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,405 +10,4295 @@ __version__ = '0.1.13'
 __license__ = 'MIT'
 
 # Python.
+import os
+import sys
+import logging
+import argparse
 from re import compile
+from random import random
+from importlib import import_module
+from copy import deepcopy
+from functools import wraps
+from inspect import iscoroutinefunction
+from time import monotonic, perf_counter
+from struct import Struct
+from itertools import islice
+from threading import Lock, Thread, Event
+from contextvars import ContextVar
+from collections import OrderedDict, deque
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 from datetime import datetime, timedelta, tzinfo
 
 # Pymongo.
-from pymongo import MongoClient
-from pymongo.son_manipulator import SONManipulator
+from pymongo import (MongoClient, ASCENDING, DESCENDING, TEXT, IndexModel,
+                     InsertOne, UpdateOne, ReplaceOne, ReturnDocument)
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, InvalidOperation, WriteError
+from bson import decode, decode_file_iter, encode, json_util
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidDocument
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
 
+# Asyncio support comes with pymongo 4.10 and later.
+try:
+    from pymongo import AsyncMongoClient
+
+except ImportError:
+    AsyncMongoClient = None
+
+# Client and database of the default connection.
 connection = None
 db = None
-_manipulators = []
 
-# MongoDB will not store dates with milliseconds.
-milli_trim = lambda x: x.replace(microsecond=int((x.microsecond/1000)*1000))
+# Databases by connection alias, and how they were set up, so that asyncio
+# clients can be created for them when first needed.
+_databases = {}
+_async_databases = {}
+_settings = {}
+
+# Model classes by the name of their collection.
+_models = {}
+
+# Index options compared when checking declared indexes against existing ones.
+_index_options = ('unique', 'sparse', 'expireAfterSeconds',
+                  'partialFilterExpression')
+
+# Options of text indexes, with the values the server gives them.
+_text_options = (('default_language', 'english'),
+                 ('language_override', 'language'))
+
+# MongoDB will not store dates with milliseconds.
+milli_trim = lambda x: x.replace(microsecond=int((x.microsecond/1000)*1000))
+
+
+# Values of these types can't be changed in place.
+_immutable_types = (str, bytes, int, float, bool, datetime, ObjectId,
+                    type(None))
+
+
+# Update operators of Model.update and friends, by keyword argument.
+_update_operators = {'set': '$set', 'unset': '$unset', 'inc': '$inc',
+                     'push': '$push', 'pull': '$pull',
+                     'add_to_set': '$addToSet'}
+
+# The IdentityMap in use by the current thread or asyncio task, if any.
+_identity_map = ContextVar('manga_identity_map', default=None)
+
+# Instrumentation listeners (see Listener), and the Operation being run by
+# the current thread or asyncio task, if they are listening. Errors raised by
+# listeners are logged here instead of failing the operation.
+_listeners = []
+_log = logging.getLogger('manga')
+_operation = ContextVar('manga_operation', default=None)
+
+
+class _Empty(Mapping):
+    '''
+    Read-only empty mapping, shared by documents until they need their own
+    changes or converted values, to save allocating two dicts per loaded
+    document. Pickling and copying it gives back the same one, so documents
+    can still be pickled and copied.
+    '''
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return False
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+    def __reduce__(self):
+        return '_empty'
+
+
+_empty = _Empty()
+
+# Change stream operations on a single document, see Model.watch.
+_document_changes = ('insert', 'update', 'replace', 'delete')
+
+# Marks the end of a change stream for View.
+_ended = object()
+
+# Sizes of the values of the BSON element types that have a fixed size, by
+# type number, see _RawData.
+_element_sizes = {1: 8, 6: 0, 7: 12, 8: 1, 9: 8, 10: 0, 16: 4, 17: 8, 18: 8,
+                  19: 16, 127: 0, 255: 0}
+_int32 = Struct('<i')
+
+# Decoding of the documents encoded by Model.to_bson.
+_raw_options = CodecOptions(document_class=RawBSONDocument, tz_aware=True)
+
+# Decoding of the stored values kept to find out what changed, see _copy.
+_snapshot_options = CodecOptions(tz_aware=True)
+
+
+class _Snapshot(object):
+    '''
+    What a stored value that may be changed in place was, kept as a BSON
+    document holding just that value, under the name of its field. Encoding
+    it is much cheaper than copying it, and telling whether it changed only
+    needs encoding the current value again.
+    '''
+
+    __slots__ = ('bson', 'options')
+
+    def __init__(self, bson, options=_snapshot_options):
+        self.bson = bson
+        self.options = options
+
+    def value(self):
+        return decode(self.bson, self.options).popitem()[1]
+
+    def matches(self, name, value):
+        '''Tells if value is still what was kept for the field name.'''
+
+        try:
+            return encode({name: value}) == self.bson
+
+        except InvalidDocument:
+            return False
+
+
+def _copy(value, name=''):
+    '''
+    Keeps what a stored value of the field name was, as a _Snapshot if it
+    may be changed in place, see _original.
+    '''
+
+    if not isinstance(value, (dict, list)):
+        return value
+
+    try:
+        return _Snapshot(encode({name: value}))
+
+    except InvalidDocument:
+        # Values not stored yet may not be encodable.
+        return deepcopy(value)
+
+
+def _kept(value):
+    '''The stored value kept by _copy.'''
+
+    return value.value() if isinstance(value, _Snapshot) else value
+
+
+def _lookup(son, path):
+    '''Gets the value at a dotted path of a stored document, or None.'''
+
+    for key in path.split('.'):
+        son = son.get(key) if isinstance(son, dict) else None
+
+    return son
+
+
+def _apply_update(operator, value, operand):
+    '''Does to a stored value what an update operator does to it.'''
+
+    if operator == 'inc':
+        return (value or 0) + operand
+
+    items = list(value or [])
+
+    if operator == 'pull':
+        return [x for x in items if x != operand]
+
+    if operator == 'push' or operand not in items:
+        items.append(operand)
+
+    return items
+
+
+def _shape(spec):
+    '''Gives the shape of a query, with the values left out as '?'.'''
+
+    if isinstance(spec, dict):
+        return dict((key, _shape(value)) for key, value in spec.items())
+
+    # Lists of conditions, as in $or, keep their shapes.
+    if isinstance(spec, list) and spec and isinstance(spec[0], dict):
+        return [_shape(x) for x in spec]
+
+    return '?'
+
+
+def _index_keys(keys, weights):
+    '''
+    Gives the keys of an index with its text fields replaced by _fts and
+    _ftsx, as the server reports them, and the weights of the text fields.
+    '''
+
+    shape, text = [], {}
+
+    for name, kind in keys:
+        if kind == TEXT and name != '_fts':
+            text[name] = 1
+
+        if kind == TEXT or name == '_ftsx':
+            if ('_fts', TEXT) not in shape:
+                shape += [('_fts', TEXT), ('_ftsx', 1)]
+
+            continue
+
+        shape.append((name, kind))
+
+    text.update(weights or {})
+
+    return shape, text
+
+
+def _same_index(info, document):
+    '''
+    Tells if an index as given by index_information matches the document
+    of an IndexModel.
+    '''
+
+    keys, weights = _index_keys(info['key'], info.get('weights'))
+
+    if (keys, weights) != _index_keys(document['key'].items(),
+                                      document.get('weights')):
+        return False
+
+    if weights:
+        for option, default in _text_options:
+            if info.get(option, default) != document.get(option, default):
+                return False
+
+    return all(info.get(x) == document.get(x) for x in _index_options)
+
+
+def _diff(path, old, new, sets, unsets):
+    '''
+    Fills sets and unsets with the dotted paths needed to turn old into new.
+    Embedded documents and dicts are compared key by key, anything else is
+    replaced as a whole.
+    '''
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, val in new.items():
+            subpath = '%s.%s' % (path, key)
+
+            if key in old:
+                _diff(subpath, old[key], val, sets, unsets)
+
+            else:
+                sets[subpath] = val
+
+        for key in old:
+            if key not in new:
+                unsets['%s.%s' % (path, key)] = ''
+
+    elif old != new or type(old) is not type(new):
+        sets[path] = new
+
+
+def setup(database_name=None, uri=None, alias='default', **kwargs):
+    '''
+    Connects to MongoDB, at uri if given (a mongodb:// connection string,
+    which may name a replica set, read preference and so on) or on
+    localhost. Other keyword arguments are handed to MongoClient, for
+    instance maxPoolSize. The database defaults to the one in the uri.
+
+    Models use the 'default' connection, unless their _database attribute
+    names another alias. Setting up an alias again replaces it.
+
+    The asyncio methods of models (afind, asave...) use an AsyncMongoClient
+    with the same settings, created the first time one of them is called.
+    '''
+
+    global db, connection
+
+    kwargs.setdefault('tz_aware', True)
+    client = MongoClient(uri or 'localhost', **kwargs)
+
+    if database_name:
+        database = client[database_name]
+
+    else:
+        database = client.get_default_database()
+
+    if alias in _databases:
+        _databases[alias].client.close()
+
+    if alias in _async_databases:
+        # Closing an asyncio client has to be awaited, so it's left to be
+        # collected instead.
+        del _async_databases[alias]
+
+    _databases[alias] = database
+    _settings[alias] = (uri, kwargs)
+
+    if alias == 'default':
+        db, connection = database, client
+
+    return database
+
+
+def ensure_indexes(drop=False):
+    '''
+    Runs Model.ensure_indexes for every model, returning their IndexReports
+    by collection.
+    '''
+
+    return dict((name, _models[name].ensure_indexes(drop))
+                for name in sorted(_models))
+
+
+def add_listener(listener):
+    '''Has listener, a Listener, told about the operations of all models.'''
+
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def _async_database(alias):
+    '''Returns the asyncio database for alias, connecting if needed.'''
+
+    if alias not in _async_databases:
+        if AsyncMongoClient is None:
+            raise MangaException('Asyncio support needs pymongo 4.10 or up.')
+
+        uri, kwargs = _settings[alias]
+        client = AsyncMongoClient(uri or 'localhost', **kwargs)
+        _async_databases[alias] = client[_databases[alias].name]
+
+    return _async_databases[alias]
+
+
+class UTC(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return "UTC"
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+class MangaException(Exception):
+    pass
+
+class ValidationError(MangaException):
+    def __init__(self, cls, attr, val):
+        self.cls = cls
+        self.attr = attr
+        self.val = val
+
+    def __str__(self):
+        return "%s: trying to set %s <- %s" % (self.cls, self.attr, self.val)
+
+class DeserializationError(MangaException):
+    def __init__(self, field, val):
+        self.fld = field
+        self.val = val
+
+    def __str__(self):
+        msg = "Can't deserialize value for field %s: %s"
+
+        return "Can't deserialize field %s with %s" % (self.fld, self.val)
+
+class NotLoadedError(MangaException):
+    def __init__(self, cls, attr):
+        self.cls = cls
+        self.attr = attr
+
+    def __str__(self):
+        return "%s: field %s was not loaded" % (self.cls, self.attr)
+
+
+class BulkResult(object):
+    '''
+    Outcome of Model.save_many: the documents that were saved, and a list of
+    (document, error) pairs for the ones that were not.
+    '''
+
+    def __init__(self):
+        self.saved = []
+        self.errors = []
+
+
+class IndexReport(object):
+    '''
+    Outcome of Model.ensure_indexes: names of the indexes that were created,
+    of those that exist with other keys or options than declared (changed),
+    and of those that exist but are not declared (extra).
+    '''
+
+    def __init__(self):
+        self.created = []
+        self.changed = []
+        self.extra = []
+
+
+class IdentityMap(object):
+    '''
+    Unit of work keeping a single instance per stored document. Within a
+    "with IdentityMap():" block, models loaded in full are remembered by
+    _id, and find_one by _id returns the instance already loaded instead of
+    reading it again. The hits and misses of those lookups are counted.
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._objects = {}
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_identity_map.set(self))
+
+        return self
+
+    def __exit__(self, *exc_info):
+        _identity_map.reset(self._tokens.pop())
+
+    def get(self, key):
+        obj = self._objects.get(key)
+
+        if obj is None:
+            self.misses += 1
+
+        else:
+            self.hits += 1
+
+        return obj
+
+    def add(self, key, obj):
+        '''Remembers obj, unless there is an instance already, returned.'''
+
+        return self._objects.setdefault(key, obj)
+
+    def discard(self, key):
+        self._objects.pop(key, None)
+
+    def clear(self, prefix=None):
+        '''Forgets everything, or the keys starting with prefix.'''
+
+        if prefix is None:
+            self._objects.clear()
+
+        else:
+            for key in [x for x in self._objects if x[:len(prefix)] == prefix]:
+                del self._objects[key]
+
+
+class Cache(object):
+    '''
+    Process-wide read-through cache for find_one by _id, enabled by setting
+    it as the _cache of one or more models. Holds up to size documents,
+    dropping the least recently used first, for ttl seconds if given.
+
+    Saving, deleting and removing through the models keep it up to date,
+    but writes made elsewhere are only seen once their entries expire.
+    '''
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] is not None and \
+                    entry[0] < monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+            return entry[1]
+
+    def set(self, key, son):
+        expires = None if self.ttl is None else monotonic() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (expires, son)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self, prefix=None):
+        '''Drops everything, or the keys starting with prefix.'''
+
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+
+            else:
+                for key in [x for x in self._entries
+                            if x[:len(prefix)] == prefix]:
+                    del self._entries[key]
+
+
+class Operation(object):
+    '''
+    What listeners are told about an operation of a model: the model and
+    its collection, the operation name (find, find_one, save, save_many,
+    delete, remove, update or find_one_and_update), its query (spec) and
+    the shape of it, and once finished, how many documents it read or
+    wrote, its duration in seconds, the part of it spent building instances
+    from stored data (decode_time), the part spent validating documents
+    (validate_time), the rest (driver_time) and the exception it raised, if
+    any.
+
+    A find lasts for as long as its results are iterated: it finishes when
+    they run out, on an error, or when the QuerySet is closed or collected
+    before that, like when breaking out of a loop over it.
+    '''
+
+    def __init__(self, model, name, spec=None):
+        self.model = model
+        self.collection = model._collection
+        self.name = name
+        self.spec = spec
+        self.shape = None if spec is None else _shape(spec)
+        self.count = 0
+        self.duration = 0.0
+        self.decode_time = 0.0
+        self.validate_time = 0.0
+        self.driver_time = 0.0
+        self.error = None
+
+    def start(self):
+        for listener in _listeners:
+            try:
+                listener.started(self)
+
+            except Exception:
+                _log.exception('Listener %r failed on %s.', listener, self)
+
+        self._start = perf_counter()
+
+    def finish(self, error=None):
+        self.duration = perf_counter() - self._start
+        self.driver_time = self.duration - self.decode_time - \
+            self.validate_time
+        self.error = error
+
+        for listener in _listeners:
+            try:
+                listener.finished(self)
+
+            except Exception:
+                _log.exception('Listener %r failed on %s.', listener, self)
+
+    def __str__(self):
+        return '%s %s' % (self.collection, self.name)
+
+
+class Listener(object):
+    '''
+    Base class for instrumentation listeners, which are registered with
+    add_listener and told when each Operation starts and finishes. Listeners
+    are called in the thread running the operation, so they should be quick.
+    Exceptions they raise are logged to the manga logger and otherwise
+    ignored, so they never change the outcome of an operation.
+    '''
+
+    def started(self, operation):
+        pass
+
+    def finished(self, operation):
+        pass
+
+
+class LatencyStats(Listener):
+    '''
+    Listener keeping the durations of the last size operations of each
+    collection and operation name, to report their percentiles.
+    '''
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._durations = {}
+        self._lock = Lock()
+
+    def finished(self, operation):
+        key = (operation.collection, operation.name)
+
+        with self._lock:
+            if key not in self._durations:
+                self._durations[key] = deque(maxlen=self.size)
+
+            self._durations[key].append(operation.duration)
+
+    def percentile(self, collection, name, percent):
+        '''Duration under which percent of the operations finished.'''
+
+        with self._lock:
+            durations = sorted(self._durations.get((collection, name), ()))
+
+        if not durations:
+            return None
+
+        index = int(round(percent / 100.0 * len(durations) + 0.5)) - 1
+
+        return durations[max(0, min(index, len(durations) - 1))]
+
+    def summary(self):
+        '''
+        Returns the count, p50 and p99 durations by (collection, operation
+        name) pair.
+        '''
+
+        return dict((key, {'count': len(self._durations[key]),
+                           'p50': self.percentile(key[0], key[1], 50),
+                           'p99': self.percentile(key[0], key[1], 99)})
+                    for key in list(self._durations))
+
+
+class QueryPlan(object):
+    '''
+    What ExplainCapture found out about a query shape of a collection: the
+    winning plan of its first explained query, whether it scans the whole
+    collection (collscan), its top level field names (keys), whether an
+    index declared in the model starts with one of them (indexed), and how
+    many times and for how long at most the shape was seen.
+    '''
+
+    def __init__(self, operation, plan):
+        self.collection = operation.collection
+        self.shape = operation.shape
+        self.plan = plan
+        self.collscan = 'COLLSCAN' in _plan_stages(plan)
+        self.keys = sorted(_query_keys(operation.spec or {}))
+        self.indexed = _declares_index(operation.model, self.keys)
+        self.count = 0
+        self.duration = 0.0
+
+    def __str__(self):
+        problems = [x for x, bad in (('COLLSCAN', self.collscan),
+                                     ('no declared index', not self.indexed))
+                    if bad]
+
+        return '%s %s: %s (seen %s times, up to %.3fs)' % (
+            self.collection, self.shape, ', '.join(problems) or 'ok',
+            self.count, self.duration)
+
+
+class ExplainCapture(Listener):
+    '''
+    Listener explaining the queries of find and find_one that take longer
+    than threshold seconds, or a sampled fraction of all of them, once for
+    each query shape, to find collection scans and queries no declared
+    index serves. Meant to run along a test suite, against a MongoDB server
+    with the indexes created (see ensure_indexes).
+    '''
+
+    def __init__(self, threshold=0.1, sample=0.0):
+        self.threshold = threshold
+        self.sample = sample
+        self.plans = {}
+
+    def finished(self, operation):
+        if operation.name not in ('find', 'find_one') or operation.error:
+            return
+
+        key = (operation.collection, repr(operation.shape))
+        plan = self.plans.get(key)
+
+        if plan is None:
+            if operation.duration < self.threshold and \
+                    random() >= self.sample:
+                return
+
+            collection = operation.model._get_collection()
+            explained = collection.find(operation.spec).explain()
+            winning = explained.get('queryPlanner', {}).get('winningPlan')
+            plan = self.plans[key] = QueryPlan(operation, winning)
+
+        plan.count += 1
+        plan.duration = max(plan.duration, operation.duration)
+
+    def issues(self):
+        '''The QueryPlans of the collection scans and unindexed queries.'''
+
+        return [x for x in self.plans.values()
+                if x.collscan or not x.indexed]
+
+    def report(self):
+        '''Text with a line for each issue, for printing in CI runs.'''
+
+        return '\n'.join(str(x) for x in self.issues())
+
+
+def _plan_stages(plan):
+    '''Gives the names of all the stages of an explained plan.'''
+
+    stages = set()
+
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+
+        for value in plan.values():
+            stages.update(_plan_stages(value))
+
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.update(_plan_stages(value))
+
+    return stages
+
+
+def _query_keys(spec):
+    '''Gives the top level field names a query filters on.'''
+
+    keys = set()
+
+    for key, value in spec.items():
+        if key in ('$and', '$or', '$nor'):
+            for subspec in value:
+                keys.update(_query_keys(subspec))
+
+        elif not key.startswith('$'):
+            keys.add(key.split('.')[0])
+
+    return keys
+
+
+def _declares_index(model, keys):
+    '''Tells if an index declared for model starts with one of keys.'''
+
+    if not keys or '_id' in keys:
+        return True
+
+    for index in model._index_models:
+        first = list(index.document['key'])[0]
+
+        if first.split('.')[0] in keys:
+            return True
+
+    return False
+
+
+def _instrumented(name, query=False):
+    '''
+    Decorates Model methods to report them to listeners, if any, as the
+    operation name. With query, their first argument is the query.
+    '''
+
+    def start(target, args, kwargs):
+        if isinstance(target, type):
+            spec = (args[0] if args else kwargs.get('spec')) if query else None
+
+            if spec is not None and not isinstance(spec, dict):
+                spec = {'_id': spec}
+
+            operation = Operation(target, name, spec)
+
+        else:
+            operation = Operation(target.__class__, name, {'_id': target._id})
+
+        operation.start()
+
+        return operation, _operation.set(operation)
+
+    def finish(operation, token, target, result, error=None):
+        _operation.reset(token)
+
+        if error is None:
+            operation.count = _result_count(target, result)
+
+        operation.finish(error)
+
+    def decorator(method):
+        if iscoroutinefunction(method):
+            @wraps(method)
+            async def wrapper(target, *args, **kwargs):
+                if not _listeners:
+                    return await method(target, *args, **kwargs)
+
+                operation, token = start(target, args, kwargs)
+
+                try:
+                    result = await method(target, *args, **kwargs)
+
+                except Exception as exc:
+                    finish(operation, token, target, None, exc)
+
+                    raise
+
+                finish(operation, token, target, result)
+
+                return result
+
+        else:
+            @wraps(method)
+            def wrapper(target, *args, **kwargs):
+                if not _listeners:
+                    return method(target, *args, **kwargs)
+
+                operation, token = start(target, args, kwargs)
+
+                try:
+                    result = method(target, *args, **kwargs)
+
+                except Exception as exc:
+                    finish(operation, token, target, None, exc)
+
+                    raise
+
+                finish(operation, token, target, result)
+
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def _result_count(target, result):
+    '''Number of documents an instrumented method read or wrote.'''
+
+    if not isinstance(target, type):
+        return 1
+
+    # Unacknowledged writes don't tell.
+    if getattr(result, 'acknowledged', True) is False:
+        return 0
+
+    if isinstance(result, BulkResult):
+        return len(result.saved)
+
+    for attr in ('deleted_count', 'modified_count'):
+        if hasattr(result, attr):
+            return getattr(result, attr)
+
+    return 0 if result is None else 1
+
+
+class _SlotData(MutableMapping):
+    '''
+    Stands for the _data dict of compact documents, whose stored values are
+    kept in slots, one per field, plus an _extra dict for stored values not
+    belonging to any field.
+    '''
+
+    __slots__ = ('_doc', '_slots')
+
+    def __init__(self, doc):
+        self._doc = doc
+        self._slots = doc._slots
+
+    def __getitem__(self, key):
+        if key in self._slots:
+            try:
+                return getattr(self._doc, self._slots[key])
+
+            except AttributeError:
+                raise KeyError(key)
+
+        elif self._doc._extra is not None:
+            return self._doc._extra[key]
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._slots:
+            setattr(self._doc, self._slots[key], value)
+
+        else:
+            if self._doc._extra is None:
+                self._doc._extra = {}
+
+            self._doc._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._slots:
+            try:
+                delattr(self._doc, self._slots[key])
+
+            except AttributeError:
+                raise KeyError(key)
+
+        elif self._doc._extra is not None:
+            del self._doc._extra[key]
+
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key, slot in self._slots.items():
+            if hasattr(self._doc, slot):
+                yield key
+
+        if self._doc._extra:
+            for key in list(self._doc._extra):
+                yield key
+
+    def __len__(self):
+        return sum(1 for x in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _RawData(MutableMapping):
+    '''
+    Stands for the _data dict of documents read as RawBSONDocuments, see
+    QuerySet.lazy_decode. A field is decoded from the BSON bytes when first
+    read, going through them only as far as needed to find it, and a dict
+    of all the fields is only made when the data is changed.
+    '''
+
+    __slots__ = ('_bson', '_options', '_offsets', '_next', '_values',
+                 '_dict')
+
+    def __init__(self, raw, options):
+        self._bson = raw.raw
+        self._options = options
+
+        # Where each element found so far starts and ends in the bytes, and
+        # where to look for the next one.
+        self._offsets = {}
+        self._next = 4
+
+        self._values = {}
+        self._dict = None
+
+    def __getitem__(self, key):
+        if self._dict is not None:
+            return self._dict[key]
+
+        try:
+            return self._values[key]
+
+        except KeyError:
+            pass
+
+        if key not in self._offsets:
+            self._seek(key)
+
+        start, end = self._offsets[key]
+        element = self._bson[start:end]
+        son = _int32.pack(len(element) + 5) + element + b'\x00'
+        value = self._values[key] = decode(son, self._options)[key]
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._materialize()[key] = value
+
+    def __delitem__(self, key):
+        del self._materialize()[key]
+
+    def __iter__(self):
+        if self._dict is not None:
+            return iter(self._dict)
+
+        self._seek(None)
+
+        return iter(list(self._offsets))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def snapshot(self, key):
+        '''
+        A _Snapshot of the stored value of key straight from the bytes, or
+        None once the data was changed.
+        '''
+
+        if self._dict is not None or key not in self._offsets:
+            return None
+
+        start, end = self._offsets[key]
+        element = self._bson[start:end]
+        son = _int32.pack(len(element) + 5) + element + b'\x00'
+
+        return _Snapshot(son, self._options)
+
+    def _seek(self, key):
+        '''Finds the elements up to the one named key, or all of them.'''
+
+        data = self._bson
+        offsets = self._offsets
+        position = self._next
+        end = len(data) - 1
+
+        while position < end and key not in offsets:
+            kind = data[position]
+            start = data.index(b'\x00', position + 1) + 1
+            size = _element_sizes.get(kind)
+
+            if size is None:
+                size = _element_size(data, kind, start)
+
+            name = data[position + 1:start - 1].decode()
+            offsets[name] = (position, start + size)
+            position = start + size
+
+        self._next = position
+
+    def _materialize(self):
+        if self._dict is None:
+            self._dict = dict((x, self[x]) for x in self)
+
+        return self._dict
+
+    def stored(self):
+        '''
+        The stored values, as decoded before the data was first changed, or
+        None if it wasn't.
+        '''
+
+        return None if self._dict is None else self._values
+
+
+def _element_size(data, kind, start):
+    '''Size of the value of a BSON element of variable size at start.'''
+
+    if kind in (3, 4, 15):
+        # Embedded documents, arrays and code with scope include their size.
+        return _int32.unpack_from(data, start)[0]
+
+    if kind in (2, 13, 14):
+        return 4 + _int32.unpack_from(data, start)[0]
+
+    if kind == 5:
+        return 5 + _int32.unpack_from(data, start)[0]
+
+    if kind == 11:
+        # A regular expression, as its pattern and options C strings.
+        return data.index(b'\x00', data.index(b'\x00', start) + 1) + 1 - start
+
+    if kind == 12:
+        return 16 + _int32.unpack_from(data, start)[0]
+
+    raise MangaException('Unknown BSON element type %s.' % kind)
+
+
+def _get_slot_data(doc):
+    return _SlotData(doc)
+
+
+def _set_slot_data(doc, data):
+    for slot in doc._slots.values():
+        if hasattr(doc, slot):
+            delattr(doc, slot)
+
+    doc._extra = None
+    view = _SlotData(doc)
+
+    for key, value in data.items():
+        view[key] = value
+
+
+# The state of compact documents other than their stored values, which are
+# pickled and copied as a plain dict instead of slot by slot.
+_slot_state = ('_original', '_converted', '_loaded', '_persisted', '_valid',
+               '_stored')
+
+
+def _get_slot_state(doc):
+    state = dict((x, getattr(doc, x)) for x in _slot_state if hasattr(doc, x))
+    state['_data'] = dict(doc._data)
+
+    return state
+
+
+def _set_slot_state(doc, state):
+    for key, value in state.items():
+        setattr(doc, key, value)
+
+
+class ModelType(type):
+    """
+    This is a type that generates Model classes properly, setting their
+    attributes not to be instances of Field, but rather an API for MongoDB
+    itself.
+    """
+
+    @staticmethod
+    def get_maker(attr):
+        def getter(cls, attr=attr):
+            try:
+                return cls._converted[attr]
+
+            except KeyError:
+                value = cls._data.get(attr)
+
+            if cls._loaded is not None and attr not in cls._loaded:
+                raise NotLoadedError(cls.__class__.__name__, attr)
+
+            # Values handed out may be mutated in place, so keep a snapshot
+            # of what was there to find out what changed when saving.
+            if attr not in cls._original:
+                if cls._original is _empty:
+                    cls._original = {}
+
+                data = cls._data
+                kept = None
+
+                if type(data) is _RawData:
+                    kept = data.snapshot(attr)
+
+                cls._original[attr] = kept or _copy(value, attr)
+
+            python_val = cls._fields[attr].to_python(value)
+
+            if cls._converted is _empty:
+                cls._converted = {}
+
+            cls._converted[attr] = python_val
+
+            return python_val
+
+        return getter
+
+    @staticmethod
+    def set_maker(attr):
+        def setter(cls, val=None, attr=attr):
+            try:
+                cls._fields[attr].validate(val)
+
+            except AssertionError:
+                raise ValidationError(cls.__class__.__name__, attr, val)
+
+            else:
+                if attr not in cls._original:
+                    if cls._original is _empty:
+                        cls._original = {}
+
+                    cls._original[attr] = cls._data.get(attr)
+
+                stored = cls._fields[attr].to_storage(val)
+                cls._data[attr] = stored
+
+                if cls._valid is _empty:
+                    cls._valid = {}
+
+                cls._valid[attr] = stored
+
+                if attr in cls._converted:
+                    del cls._converted[attr]
+
+                if cls._loaded is not None:
+                    cls._loaded = cls._loaded | set([attr])
+
+        return setter
+
+    @staticmethod
+    def collect_indexes(fields, indexes):
+        '''
+        Builds pymongo IndexModels for the fields declared with index or
+        unique, and for the entries of the _indexes list of a model. These
+        can be IndexModels, field names, lists of field names or (field,
+        direction) pairs for compound indexes, or dicts with such a list as
+        'keys' and index options (unique, expireAfterSeconds,
+        partialFilterExpression...) as the other items.
+        '''
+
+        models = []
+
+        for fname, field in sorted(fields.items()):
+            if field.index or field.unique:
+                direction = field.index
+
+                if direction is True or direction is False:
+                    direction = ASCENDING
+
+                options = {'unique': True} if field.unique else {}
+                models.append(IndexModel([(fname, direction)],
+                                         background=True, **options))
+
+        for index in indexes:
+            if isinstance(index, IndexModel):
+                models.append(index)
+
+                continue
+
+            if isinstance(index, dict):
+                options = dict(index)
+                keys = options.pop('keys')
+
+            else:
+                keys, options = index, {}
+
+            if isinstance(keys, str):
+                keys = [keys]
+
+            keys = [(x, ASCENDING) if isinstance(x, str) else x for x in keys]
+
+            options.setdefault('background', True)
+            models.append(IndexModel(keys, **options))
+
+        names = set()
+        unique_models = []
+
+        for model in models:
+            if model.document['name'] not in names:
+                names.add(model.document['name'])
+                unique_models.append(model)
+
+        return unique_models
+
+    @staticmethod
+    def inlined(field, var):
+        '''
+        Returns the inlined source of the validation of field, or None if
+        validate has to be called, as it was overridden without overriding
+        inline_validate too.
+        '''
+
+        kind = type(field)
+
+        for klass in kind.__mro__:
+            if 'inline_validate' in klass.__dict__:
+                if klass.__dict__.get('validate') is kind.validate:
+                    return field.inline_validate(var)
+
+                return None
+
+    @staticmethod
+    def pre_saved(field):
+        '''Tells whether saving has to call pre_save_val on field.'''
+
+        if field.pre_save is None:
+            return type(field).pre_save_val is not Field.pre_save_val
+
+        return field.pre_save
+
+    @classmethod
+    def plan_saving(mcs, rich_cls):
+        '''
+        Works out once per class what saving its instances goes through:
+        the fields with a pre_save_val (_pre_save_fields), the storage
+        conversions of the fields that have one (_storage), and the order
+        of the fields in encoded documents, _id first (_layout).
+        '''
+
+        fields = rich_cls._fields.items()
+
+        rich_cls._pre_save_fields = tuple((x, field) for x, field in fields
+                                          if mcs.pre_saved(field))
+        rich_cls._storage = dict(
+            (x, field.to_storage) for x, field in fields
+            if type(field).to_storage is not Field.to_storage)
+        rich_cls._layout = tuple(sorted(rich_cls._fields,
+                                        key=lambda x: x != '_id'))
+
+    @staticmethod
+    def compile(source, name, namespace):
+        namespace = dict(globals(), **namespace)
+        exec(source, namespace)
+
+        function = namespace[name]
+        function._compiled = True
+
+        return function
+
+    @classmethod
+    def compile_validate(mcs, rich_cls):
+        '''
+        Generates Document.validate for a class, with the fields unrolled in
+        order and their checks inlined where possible, and without calling
+        to_python for fields that don't convert values.
+        '''
+
+        namespace = {'_cls': rich_cls, '_generic': Document.validate,
+                     '_names': frozenset(rich_cls._fields),
+                     '_cls_name': rich_cls.__name__}
+        lines = ['def validate(self, exclude=None):',
+                 '    if self.__class__ is not _cls:',
+                 '        return _generic(self, exclude)',
+                 '    data = self._data',
+                 '    converted = self._converted',
+                 '    loaded = self._loaded',
+                 '    skip = set(exclude) if exclude else ()',
+                 '    if loaded is not None:',
+                 '        skip = (_names - loaded).union(skip)',
+                 '    fname = None',
+                 '    try:']
+
+        for index, (fname, field) in enumerate(rich_cls._fields.items()):
+            if type(field).to_python is Field.to_python:
+                conversion = 'data.get(%r)' % fname
+
+            else:
+                namespace['_to_python_%s' % index] = field.to_python
+                conversion = '_to_python_%s(data.get(%r))' % (index, fname)
+
+            checks = mcs.inlined(field, 'value')
+
+            if checks is None:
+                namespace['_validate_%s' % index] = field.validate
+                checks = ['_validate_%s(value)' % index]
+
+            lines += ['        if %r not in skip:' % fname,
+                      '            fname = %r' % fname]
+
+            # Lazy fields are validated as stored, what they hand out being
+            # None for references to documents that are gone.
+            if field.lazy:
+                lines.append('            value = data.get(%r)' % fname)
+
+            else:
+                lines += ['            if fname in converted:',
+                          '                value = converted[fname]',
+                          '            else:',
+                          '                value = %s' % conversion]
+
+            lines += ['            %s' % x for x in checks]
+
+        lines += ['        pass',
+                  '    except AssertionError:',
+                  '        val = data.get(fname)',
+                  '        raise ValidationError(_cls_name, fname, val)']
+
+        return mcs.compile('\n'.join(lines), 'validate', namespace)
+
+    @classmethod
+    def compile_init(mcs, rich_cls):
+        '''
+        Generates Document.__init__ for a class, with the fields unrolled in
+        order and their defaults and storage conversions looked up once.
+        '''
+
+        namespace = {'_cls': rich_cls, '_generic': Document.__init__}
+        fields = list(rich_cls._fields.items())
+        son_items = ', '.join('%r: son.get(%r)' % (x, x) for x, _ in fields)
+        lines = ['def __init__(self, data=None, son=None):',
+                 '    if self.__class__ is not _cls:',
+                 '        return _generic(self, data, son)',
+                 '    self._original = self._converted = _empty',
+                 '    self._loaded = self._stored = None',
+                 '    self._persisted = False',
+                 '    if son:',
+                 '        self._data = {%s}' % son_items,
+                 '        self.validate()',
+                 '        self._valid = dict(self._data)',
+                 '        return',
+                 '    data = data or {}',
+                 '    exempt = []']
+        stored = []
+
+        for index, (fname, field) in enumerate(fields):
+            namespace['_default_%s' % index] = field.default
+            default = '_default_%s' % index
+
+            if callable(field.default):
+                default += '()'
+
+            lines += ['    val = data[%r] if %r in data else %s' %
+                      (fname, fname, default),
+                      '    if not val:',
+                      '        exempt.append(%r)' % fname]
+
+            if type(field).to_storage is Field.to_storage:
+                lines.append('    stored_%s = val' % index)
+
+            else:
+                namespace['_to_storage_%s' % index] = field.to_storage
+                lines.append('    stored_%s = _to_storage_%s(val)' %
+                             (index, index))
+
+            stored.append('%r: stored_%s' % (fname, index))
+
+        lines += ['    self._data = {%s}' % ', '.join(stored),
+                  '    self.validate(exempt)',
+                  '    valid = dict(self._data)',
+                  '    for fname in exempt:',
+                  '        del valid[fname]',
+                  '    self._valid = valid']
+
+        return mcs.compile('\n'.join(lines), '__init__', namespace)
+
+    @staticmethod
+    def make_compact(dct, bases):
+        '''
+        Sets up a compact document class, which keeps its stored values in
+        slots instead of a dict, and has no __dict__, as long as all its
+        bases are compact or come with manga.
+        '''
+
+        slots = dict((x, '_v_%s' % x) for x in dct['_fields'])
+        new_slots = list(slots.values()) + ['_extra']
+
+        dct['_slots'] = slots
+        dct['__slots__'] = tuple(x for x in new_slots
+                                 if not any(hasattr(b, x) for b in bases))
+        dct['_data'] = property(_get_slot_data, _set_slot_data)
+        dct['__getstate__'] = _get_slot_state
+        dct['__setstate__'] = _set_slot_state
+
+    def __new__(cls, name, bases, dct):
+        dct.setdefault('_fields', {})
+        dct.setdefault('_collection', name.lower())
+
+        for x in bases:
+            dct['_fields'].update(getattr(x, '_fields', {}))
+
+        for attr, val in list(dct.items()):
+            if isinstance(val, Field):
+                dct['_fields'][attr] = val
+                dct[attr] = property(cls.get_maker(attr), cls.set_maker(attr))
+
+        compact = any(getattr(x, '_compact', False) for x in bases)
+
+        if dct.get('_compact', compact):
+            cls.make_compact(dct, bases)
+
+        rich_cls = super(ModelType, cls).__new__(cls, name, bases, dct)
+
+        # Document itself keeps the generic versions, which are also used
+        # by classes overriding them (and their subclasses).
+        for method in ('validate', '__init__'):
+            current = getattr(rich_cls, method)
+            generic = method not in dct and (
+                getattr(current, '_compiled', False) or
+                current is getattr(Document, method))
+
+            if generic:
+                compiler = getattr(cls, 'compile_%s' % method.strip('_'))
+                setattr(rich_cls, method, compiler(rich_cls))
+
+        cls.plan_saving(rich_cls)
+
+        # Models are kept by collection, to avoid two models sharing one.
+        if any([hasattr(x, 'save') for x in bases]):
+            if rich_cls._collection in _models:
+                msg = 'Model for collection %s was already defined.'
+
+                raise Exception(msg % rich_cls._collection)
+
+            _models[rich_cls._collection] = rich_cls
+
+            rich_cls._index_models = cls.collect_indexes(rich_cls._fields,
+                                                         rich_cls._indexes)
+
+        return rich_cls
+
+
+class Field(object):
+    '''Base field for all fields.'''
+
+    # Fields whose to_python is costly, like reading the database, set this
+    # to have their stored values validated as they are.
+    lazy = False
+
+    # Whether pre_save_val may give a value to store when saving, None for
+    # as long as it's not overridden.
+    pre_save = None
+
+    def __init__(self, default=None, blank=False, index=False, unique=False):
+        self.blank = blank
+        self.default = default
+
+        # Either True or a pymongo index direction, like DESCENDING or TEXT.
+        self.index = index
+        self.unique = unique
+
+    def validate(self, value):
+        if not self.blank:
+            assert value
+
+    def inline_validate(self, var):
+        '''
+        Returns source lines doing the same as validate with the value in
+        the variable var, used by ModelType to compile validators. Fields
+        which override validate have it called instead, unless they also
+        override this.
+        '''
+
+        return [] if self.blank else ['assert %s' % var]
+
+    def pre_save_val(self):
+        return None
+
+    @staticmethod
+    def to_storage(value):
+        return value
+
+    @staticmethod
+    def to_python(value):
+        return value
+
+class ObjectIdField(Field):
+    def validate(self, value):
+        assert isinstance(value, ObjectId)
+
+        if not self.blank:
+            assert value
+
+    def inline_validate(self, var):
+        lines = ['assert isinstance(%s, ObjectId)' % var]
+
+        return lines + super(ObjectIdField, self).inline_validate(var)
+
+class StringField(Field):
+    def __init__(self, default='', length=None, **kwargs):
+        super(StringField, self).__init__(default, **kwargs)
+
+        self.length = length
+
+    def validate(self, value):
+        assert isinstance(value, str)
+
+        if not self.blank:
+            assert value.strip()
+
+        if self.length:
+            length = len(value.strip())
+
+            assert length >= self.length[0] and length <= self.length[1]
+
+    def inline_validate(self, var):
+        lines = ['assert isinstance(%s, str)' % var]
+
+        if not self.blank:
+            lines.append('assert %s.strip()' % var)
+
+        if self.length:
+            lines.append('assert %r <= len(%s.strip()) <= %r' %
+                         (self.length[0], var, self.length[1]))
+
+        return lines
+
+    @staticmethod
+    def to_storage(value):
+        return value.strip()
+
+
+class EmailField(StringField):
+    email_re = compile(r'^[\S]+@[\S]+\.[\S]+$')
+
+    def __init__(self, default='', length=(5, 100), **kwargs):
+        super(EmailField, self).__init__(default, length, **kwargs)
+
+    def validate(self, value):
+        super(EmailField, self).validate(value)
+
+        if not self.email_re.match(value):
+            raise AssertionError
+
+
+class DateTimeField(Field):
+    def __init__(self, default=None, blank=False, auto=None, **kwargs):
+        super(DateTimeField, self).__init__(default, blank, **kwargs)
+
+        self.auto = auto
+
+        # Subclasses overriding pre_save_val are left to ModelType to check.
+        if type(self).pre_save_val is DateTimeField.pre_save_val:
+            self.pre_save = auto == 'modified'
+
+        if auto in ['modified', 'created']:
+            self.default = lambda: datetime.now(UTC())
+
+    def validate(self, value):
+        super(DateTimeField, self).validate(value)
+
+        assert (isinstance(value, datetime) and value.tzinfo) or value is None
+
+    def pre_save_val(self):
+        return datetime.now(UTC()) if self.auto == 'modified' else None
+
+    @staticmethod
+    def to_storage(value):
+        return milli_trim(value) if value else None
+
+
+class DictField(Field):
+    def __init__(self, default=None, **kwargs):
+
+        super(DictField, self).__init__(default or {}, **kwargs)
+
+    def validate(self, value):
+        assert isinstance(value, dict)
+
+        if not self.blank:
+            assert value != {}
+
+    def inline_validate(self, var):
+        lines = ['assert isinstance(%s, dict)' % var]
+
+        return lines + ([] if self.blank else ['assert %s != {}' % var])
+
+
+class DocumentField(Field):
+    def __init__(self, default=None, document=None, **kwargs):
+        super(DocumentField, self).__init__(default, **kwargs)
+
+        self.document_class = document
+
+    def validate(self, value):
+        if not self.blank:
+            assert value
+
+        if value:
+            assert isinstance(value, self.document_class)
+            value.validate()
+
+        else:
+            assert value is None
+
+    @staticmethod
+    def to_storage(value):
+        if not isinstance(value, Document):
+            return getattr(value, '_data', None)
+
+        value._flush()
+
+        # Compact documents don't keep their data in a dict.
+        return dict(value._data) if value._compact else value._data
+
+    def to_python(self, value):
+        if value is None:
+            return self.document_class()
+
+        # Changes made to the embedded document go straight to the data of
+        # the document holding it.
+        return self.document_class._from_son(value)
+
+class ReferenceField(Field):
+    '''
+    Reference to a document of another Model (or the collection name of the
+    Model, for models not defined yet), stored as its _id. The document is
+    read when the field is first accessed, or along with the documents of a
+    QuerySet for the fields given to its prefetch. Documents not found read
+    as None, or in a ListField as placeholders that are equal to None but
+    keep their _id.
+    '''
+
+    lazy = True
+
+    def __init__(self, model, **kwargs):
+        super(ReferenceField, self).__init__(**kwargs)
+
+        self._model = model
+
+    @property
+    def model(self):
+        if isinstance(self._model, str):
+            self._model = _models[self._model]
+
+        return self._model
+
+    def validate(self, value):
+        if not self.blank:
+            assert value is not None
+
+        # Stored values are just the _id.
+        if isinstance(value, Document):
+            assert isinstance(value, self.model)
+            assert value._id is not None
+
+    @staticmethod
+    def to_storage(value):
+        if isinstance(value, (Document, _Missing)):
+            return value._id
+
+        return value
+
+    def to_python(self, value, found=None):
+        '''
+        Reads the referenced document, unless found is given, a dict of the
+        documents already read by _id.
+        '''
+
+        if value is None:
+            return None
+
+        if found is not None:
+            return found.get(value)
+
+        return self.model.find_one(value)
+
+
+class _Missing(object):
+    '''
+    Stands for a referenced document that was not found in the items of a
+    ListField of ReferenceFields. It is falsy and equal to None, so
+    item == None finds it (though item is None doesn't), and keeps the _id
+    to store it again wherever the item ends up in the list.
+    '''
+
+    __slots__ = ('_id',)
+
+    def __init__(self, _id):
+        self._id = _id
+
+    def __eq__(self, other):
+        return other is None or other is self
+
+    def __hash__(self):
+        return hash(None)
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return '<Missing %r>' % (self._id,)
+
+
+def _references(ids, documents):
+    '''The documents read for ids, with placeholders for those not found.'''
+
+    return [_Missing(x) if doc is None and x is not None else doc
+            for x, doc in zip(ids, documents)]
+
+
+class ListField(Field):
+    def __init__(self, default=None, field=None, **kwargs):
+        default = default or []
+
+        super(ListField, self).__init__(default, **kwargs)
+
+        self.field = field
+        self.lazy = getattr(field, 'lazy', False)
+
+    def validate(self, value):
+        assert isinstance(value, list)
+
+        if not self.blank:
+            assert value
+
+        [self.field.validate(v) for v in value if self.field]
+
+    def to_storage(self, value):
+        if self.field:
+            return [self.field.to_storage(v) for v in value]
+
+        else:
+            return value
+
+    def to_python(self, value):
+        if not isinstance(value, list):
+            raise DeserializationError(self, value)
+
+        if self.lazy:
+            return _references(value, [self.field.to_python(v)
+                                       for v in value])
+
+        if self.field:
+            return [self.field.to_python(v) for v in value]
+
+        else:
+            return value
+
+
+class Document(object, metaclass=ModelType):
+    '''
+    A MongoDB storable document, without interface to persistant storage. It's
+    the base class for Models (with do have persistance) and also embedded
+    documents.
+    '''
+
+    # The state of documents: their stored data, the stored values of the
+    # fields changed since they were loaded or saved, the converted values
+    # handed out by the fields, the names of the fields that were loaded
+    # (for documents loaded with only some of their fields, None otherwise),
+    # whether they are known to be stored in the database, in which case
+    # saving them only sends the fields that changed, the stored values
+    # last found valid, which saving doesn't validate again, and the stored
+    # values as last loaded or saved, to find the ones changed straight in
+    # _data (None if unknown, or for lazily decoded data, which keeps them).
+    __slots__ = ('_data', '_original', '_converted', '_loaded', '_persisted',
+                 '_valid', '_stored', '__weakref__')
+
+    # Documents loaded from the database are trusted to be valid, as they
+    # were validated when written. Set this to revalidate them when loaded.
+    _validate_on_load = False
+
+    # Models read with this set decode each field of their documents only
+    # when first read, see QuerySet.lazy_decode.
+    _lazy_decode = False
+
+    # Compact documents keep their data in slots, which takes less memory
+    # when holding lots of them, at the cost of slower access to _data.
+    _compact = False
+
+    def __init__(self, data=None, son=None):
+        self._data = {}
+        validate_exempt = []
+
+        for fname, field in list(self._fields.items()):
+            if son:
+                self._data[fname] = son.get(fname)
+
+                continue
+
+            elif data and fname in data:
+                val = data[fname]
+
+            else:
+                val = field.default
+                val = val() if callable(val) else val
+
+            # Field skips validation if value does not come from son AND no
+            # value is given for initialization.
+            if not val:
+                validate_exempt.append(fname)
+
+            self._data[fname] = field.to_storage(val)
+
+        self._original = self._converted = _empty
+        self._loaded = self._stored = None
+        self._persisted = False
+        self.validate(exclude=validate_exempt)
+
+        self._valid = dict(self._data)
+
+        for fname in validate_exempt:
+            del self._valid[fname]
+
+    @classmethod
+    def _from_son(cls, son, loaded=None):
+        '''
+        Builds a document straight from stored data, which is used as is:
+        fields are only converted when accessed, and are not validated
+        unless _validate_on_load is set. If only some fields were loaded,
+        their names are given in loaded.
+        '''
+
+        obj = cls.__new__(cls)
+        obj._data = son
+        obj._original = obj._converted = _empty
+        obj._loaded = loaded
+        obj._persisted = False
+        obj._valid = _empty
+        obj._stored = None
+
+        if cls._validate_on_load:
+            obj.validate()
+            obj._valid = dict(son)
+
+        return obj
+
+    def validate(self, exclude=None):
+        exclude = exclude if exclude else []
+        fields = [x for x in self._fields.items() if x[0] not in exclude]
+
+        if self._loaded is not None:
+            fields = [x for x in fields if x[0] in self._loaded]
+
+        for fieldname, fieldinstance in fields:
+            try:
+                if fieldinstance.lazy:
+                    python_val = self._data.get(fieldname)
+
+                elif fieldname in self._converted:
+                    python_val = self._converted[fieldname]
+
+                else:
+                    value = self._data.get(fieldname)
+                    python_val = fieldinstance.to_python(value)
+
+                fieldinstance.validate(python_val)
+
+            except AssertionError:
+                val = self._data.get(fieldname)
+
+                raise ValidationError(self.__class__.__name__, fieldname, val)
+
+    def clean(self):
+        '''
+        Checks the document as a whole when it is saved, once its fields
+        are valid, for rules involving more than one field. Raising
+        ValidationError stops the save.
+        '''
+
+    def _validated(self):
+        '''
+        Names of the fields whose stored values were found valid and can't
+        have changed since, which don't need validating again.
+        '''
+
+        valid = self._valid
+        data = self._data
+
+        if not valid:
+            return ()
+
+        return [x for x, value in valid.items()
+                if isinstance(value, _immutable_types) and
+                data.get(x) is value]
+
+    def _flush(self):
+        '''
+        Writes the converted values handed out by the fields back to the
+        stored data, so changes made to them in place get saved.
+        '''
+
+        storage = self._storage
+        data = self._data
+
+        for fname, value in self._converted.items():
+            if isinstance(value, _immutable_types):
+                continue
+
+            if fname in storage:
+                value = storage[fname](value)
+
+            # Values made up for fields stored as None, like the empty
+            # document of a DocumentField, are only stored once changed.
+            if data.get(fname) is None and self._made_up(fname, value):
+                continue
+
+            data[fname] = value
+
+    def _track(self):
+        '''
+        Adds the stored values changed straight in _data since the document
+        was loaded or saved, which the fields didn't see, to the changes.
+        '''
+
+        stored = self._stored
+        data = self._data
+
+        if stored is None and type(data) is _RawData:
+            stored = data.stored()
+
+        if stored is None:
+            return
+
+        original = self._original
+        changed = [x for x, value in data.items() if x not in original and
+                   (x not in stored or stored[x] is not value)]
+        changed += [x for x in stored if x not in data and x not in original]
+
+        if changed and original is _empty:
+            original = self._original = {}
+
+        for fname in changed:
+            original[fname] = stored.get(fname)
+
+    def _made_up(self, fname, stored):
+        '''Tells if stored is what the field fname makes up for None.'''
+
+        field = self._fields[fname]
+
+        return stored == field.to_storage(field.to_python(None))
+
+    def _set_converted(self, fname, value):
+        '''Hands value out for the field fname, as if read from the data.'''
+
+        if self._original is _empty:
+            self._original = {}
+
+        if fname not in self._original:
+            self._original[fname] = _copy(self._data.get(fname), fname)
+
+        if self._converted is _empty:
+            self._converted = {}
+
+        self._converted[fname] = value
+
+    def _sync(self):
+        '''Marks the current data as being what is stored.'''
+
+        self._original = {} if self._converted else _empty
+
+        # Converted values may still be changed in place after this.
+        for fname in self._converted:
+            self._original[fname] = _copy(self._data.get(fname), fname)
+
+    def _changes(self):
+        '''
+        Returns the update document with the $set and $unset operations
+        needed to bring the stored document up to date with this one.
+        '''
+
+        sets, unsets = {}, {}
+
+        for fname, old in self._original.items():
+            if fname in self._data:
+                new = self._data[fname]
+
+                if isinstance(old, _Snapshot):
+                    if old.matches(fname, new):
+                        continue
+
+                    old = old.value()
+
+                _diff(fname, old, new, sets, unsets)
+
+            elif old is not None:
+                unsets[fname] = ''
+
+        changes = {}
+
+        if sets:
+            changes['$set'] = sets
+
+        if unsets:
+            changes['$unset'] = unsets
+
+        return changes
+
+
+class QuerySet(object):
+    '''
+    Cursor over the documents of a Model matching a query, yielding them as
+    instances of the model. Like pymongo cursors, options can be chained
+    until the iteration starts.
+
+    With only() or exclude(), instances are partially loaded: reading a
+    field that was left out raises NotLoadedError, and saving them only
+    updates the fields that changed.
+
+    With prefetch(), the documents referenced by some ReferenceFields (or
+    ListFields of them) are read in batches, along with the documents
+    referring to them, with one query per referenced model.
+
+    For reading lots of documents without needing instances, as_raw(),
+    values() and values_list() yield the stored data as dicts or tuples,
+    skipping building the models altogether.
+    '''
+
+    def __init__(self, cls, spec=None, projection=None, read_preference=None,
+                 **kwargs):
+        self._cls = cls
+        self._spec = spec
+        self._projection = None
+        self._read_preference = read_preference
+        self._options = kwargs
+        self._cursor = None
+
+        # Builds what is yielded for each stored document, when not models.
+        self._row = None
+
+        # Whether documents are read lazily, and then the codec options to
+        # decode their fields with.
+        self._lazy = cls._lazy_decode
+        self._decoding = None
+
+        # Reference fields to prefetch, and the instances read with them.
+        self._prefetch = []
+        self._buffer = deque()
+
+        # The Operation reporting the iteration to listeners, if any, and
+        # whether it is this one's own, not that of a find_one using it.
+        self._operation = None
+        self._reports = False
+
+        if projection is not None:
+            if not isinstance(projection, dict):
+                projection = dict((x, 1) for x in projection)
+
+            self._project(projection)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self._next()
+
+        except Exception as exc:
+            self._finish(exc)
+
+            raise
+
+    def _next(self):
+        if self._cursor is None:
+            self._start(self._cls._get_collection(self._read_preference))
+
+        if not self._prefetching():
+            return self._decode(next(self._cursor))
+
+        if not self._buffer:
+            batch = [self._decode(x) for x in
+                     islice(self._cursor, self._prefetch_size())]
+            found = {}
+
+            for model, ids in self._referenced(batch).items():
+                spec = {'_id': {'$in': list(ids)}}
+
+                if ids:
+                    found[model] = dict((x._id, x) for x in model.find(spec))
+
+            self._resolve(batch, found)
+            self._buffer.extend(batch)
+
+        if not self._buffer:
+            raise StopIteration
+
+        return self._buffer.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._anext()
+
+        except Exception as exc:
+            self._finish(exc)
+
+            raise
+
+    async def _anext(self):
+        if self._cursor is None:
+            pref = self._read_preference
+            self._start(self._cls._get_collection(pref, asynchronous=True))
+
+        if not self._prefetching():
+            return self._decode(await self._cursor.next())
+
+        if not self._buffer:
+            batch = []
+
+            try:
+                while len(batch) < self._prefetch_size():
+                    batch.append(self._decode(await self._cursor.next()))
+
+            except StopAsyncIteration:
+                pass
+
+            found = {}
+
+            for model, ids in self._referenced(batch).items():
+                spec = {'_id': {'$in': list(ids)}}
+
+                if ids:
+                    found[model] = dict([(x._id, x)
+                                         async for x in model.find(spec)])
+
+            self._resolve(batch, found)
+            self._buffer.extend(batch)
+
+        if not self._buffer:
+            raise StopAsyncIteration
+
+        return self._buffer.popleft()
+
+    def _start(self, collection):
+        self._operation = _operation.get()
+
+        if self._operation is None and _listeners:
+            self._operation = Operation(self._cls, 'find', self._spec or {})
+            self._operation.start()
+            self._reports = True
+
+        self._loaded = self._loaded_fields()
+
+        if self._lazy and self._row is None:
+            self._decoding = collection.codec_options
+            options = self._decoding.with_options(
+                document_class=RawBSONDocument)
+            collection = collection.with_options(codec_options=options)
+
+        self._cursor = collection.find(self._spec, self._projection,
+                                       **self._options)
+
+    def close(self):
+        '''Stops iterating, closing the cursor.'''
+
+        cursor = self._cursor
+
+        if cursor is not None and iscoroutinefunction(cursor.close):
+            raise MangaException('Asyncio cursors are closed with aclose.')
+
+        self._cursor = None
+
+        if cursor is not None:
+            cursor.close()
+
+        self._finish(None)
+
+    async def aclose(self):
+        '''Same as close, for asyncio.'''
+
+        cursor, self._cursor = self._cursor, None
+
+        if cursor is not None:
+            if iscoroutinefunction(cursor.close):
+                await cursor.close()
+
+            else:
+                cursor.close()
+
+        self._finish(None)
+
+    def __del__(self):
+        if getattr(self, '_reports', False):
+            self._finish(None)
+
+    def _finish(self, exc):
+        if self._reports:
+            self._reports = False
+            end = isinstance(exc, (StopIteration, StopAsyncIteration))
+            self._operation.finish(None if end else exc)
+
+    def _decode(self, son):
+        operation = self._operation
+        start = perf_counter() if operation is not None else 0
+
+        if self._row is not None:
+            obj = self._row(son)
+
+        else:
+            if self._decoding is not None:
+                son = _RawData(son, self._decoding)
+
+            obj = self._cls._from_db(son, self._loaded)
+            imap = _identity_map.get()
+
+            # Only full instances can stand for their document.
+            if imap is not None and self._loaded is None and '_id' in son:
+                obj = imap.add(self._cls._key(son['_id']), obj)
+
+        if operation is not None:
+            operation.decode_time += perf_counter() - start
+            operation.count += 1
+
+        return obj
+
+    def _check_unstarted(self):
+        if self._cursor is not None:
+            raise InvalidOperation('QuerySet already started.')
+
+    def _prefetching(self):
+        return self._prefetch and self._row is None
+
+    def _prefetch_size(self):
+        return self._options.get('batch_size') or 100
+
+    def _prefetched(self, obj, fname):
+        '''Tells if the field fname of obj is to be prefetched.'''
+
+        if obj._loaded is not None and fname not in obj._loaded:
+            return False
+
+        # Instances shared through an identity map may have read it already.
+        return fname not in obj._converted and \
+            obj._data.get(fname) is not None
+
+    def _referenced(self, batch):
+        '''Collects the ids the batch refers to, by referenced model.'''
+
+        ids = {}
+
+        for fname in self._prefetch:
+            field = self._cls._fields[fname]
+            listed = isinstance(field, ListField)
+            model = (field.field if listed else field).model
+            wanted = ids.setdefault(model, set())
+
+            for obj in batch:
+                if self._prefetched(obj, fname):
+                    value = obj._data[fname]
+                    wanted.update(value if listed else [value])
+
+        return ids
+
+    def _resolve(self, batch, found):
+        '''Hands the documents found out as the values of the fields.'''
+
+        for fname in self._prefetch:
+            field = self._cls._fields[fname]
+            listed = isinstance(field, ListField)
+            reference = field.field if listed else field
+            docs = found.get(reference.model, {})
+
+            for obj in batch:
+                if not self._prefetched(obj, fname):
+                    continue
+
+                value = obj._data[fname]
+
+                if listed:
+                    value = _references(value, [reference.to_python(x, docs)
+                                                for x in value])
+
+                else:
+                    value = reference.to_python(value, docs)
+
+                obj._set_converted(fname, value)
+
+    def _set(self, option, value):
+        self._check_unstarted()
+        self._options[option] = value
+
+        return self
+
+    def _project(self, projection):
+        self._check_unstarted()
+        self._projection = projection
+
+        return self
+
+    def _values(self, fields, row):
+        projection = dict((x, 1) for x in fields)
+
+        if '_id' not in projection:
+            projection['_id'] = 0
+
+        self._project(projection)
+        self._row = row
+
+        return self
+
+    def _loaded_fields(self):
+        '''
+        Names of the fields the projection loads, or None for all of them.
+        Fields projected in part, like 'rect.v1', count as loaded.
+        '''
+
+        if self._projection is None:
+            return None
+
+        included = [x for x, v in self._projection.items() if v]
+
+        if [x for x in included if x != '_id']:
+            loaded = set(x.split('.', 1)[0] for x in included)
+
+            if self._projection.get('_id', 1):
+                loaded.add('_id')
+
+        else:
+            excluded = [x for x, v in self._projection.items()
+                        if not v and '.' not in x]
+            loaded = set(self._cls._fields) - set(excluded)
+
+        return frozenset(loaded)
+
+    def only(self, *fields):
+        '''Loads only the given fields, and the _id.'''
+
+        return self._project(dict((x, 1) for x in fields))
+
+    def exclude(self, *fields):
+        '''Loads all fields but the given ones.'''
+
+        return self._project(dict((x, 0) for x in fields))
+
+    def prefetch(self, *fields):
+        '''
+        Reads the documents referenced by the given fields, ReferenceFields
+        or ListFields of them, in a single query per batch of results.
+        '''
+
+        self._check_unstarted()
+
+        for fname in fields:
+            field = self._cls._fields.get(fname)
+
+            if not isinstance(getattr(field, 'field', field), ReferenceField):
+                msg = '%s: %s is not a reference field.'
+
+                raise MangaException(msg % (self._cls.__name__, fname))
+
+        self._prefetch = self._prefetch + list(fields)
+
+        return self
+
+    def lazy_decode(self, lazy=True):
+        '''
+        Has the driver hand over the documents still encoded, as BSON, and
+        their fields decoded only when first read, which saves time and
+        memory when reading a few fields of big documents. The default is
+        the _lazy_decode attribute of the model. Compact models get nothing
+        from it, as their data is copied to slots when loaded.
+        '''
+
+        self._check_unstarted()
+        self._lazy = lazy
+
+        return self
+
+    def as_raw(self):
+        '''Yields the stored documents as they are, in plain dicts.'''
+
+        self._check_unstarted()
+        self._row = lambda son: son
+
+        return self
+
+    def values(self, *fields):
+        '''
+        Yields dicts with the stored values of the given fields only, which
+        may be dotted paths into embedded documents.
+        '''
+
+        if not fields:
+            return self.as_raw()
+
+        row = lambda son: dict((x, _lookup(son, x)) for x in fields)
+
+        return self._values(fields, row)
+
+    def values_list(self, *fields, flat=False):
+        '''
+        Yields tuples with the stored values of the given fields, or just
+        the value if flat is given along with a single field.
+        '''
+
+        if flat and len(fields) != 1:
+            msg = 'values_list takes a single field when flat is given.'
+
+            raise MangaException(msg)
+
+        if flat:
+            row = lambda son: _lookup(son, fields[0])
+
+        else:
+            row = lambda son: tuple(_lookup(son, x) for x in fields)
+
+        return self._values(fields, row)
+
+    def limit(self, limit):
+        return self._set('limit', limit)
+
+    def skip(self, skip):
+        return self._set('skip', skip)
+
+    def batch_size(self, batch_size):
+        return self._set('batch_size', batch_size)
+
+    def read_preference(self, read_preference):
+        '''Reads with the given pymongo ReadPreference, like SECONDARY.'''
+
+        self._check_unstarted()
+        self._read_preference = read_preference
+
+        return self
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+
+        return self._set('sort', key_or_list)
+
+    def paginate_after(self, last_id=None, page_size=100):
+        '''
+        Limits the results to the page_size documents following the one
+        with last_id, in _id order, ascending unless sorted otherwise, or the
+        first ones without last_id. Unlike skip, the cost of reading a page
+        doesn't grow with its position.
+        '''
+
+        sort = self._options.get('sort')
+
+        if sort and (len(sort) != 1 or sort[0][0] != '_id' or
+                     sort[0][1] not in (ASCENDING, DESCENDING)):
+            raise MangaException('Pages are sorted by _id only.')
+
+        self._check_unstarted()
+
+        if last_id is not None:
+            descending = sort and sort[0][1] == DESCENDING
+            after = {'_id': {'$lt' if descending else '$gt': last_id}}
+            self._spec = {'$and': [self._spec, after]} if self._spec else after
+
+        self._options['sort'] = sort or [('_id', ASCENDING)]
+
+        return self.limit(page_size)
+
+    def pages(self, page_size=100, last_id=None):
+        '''
+        Yields all the results in lists of page_size, each read by its own
+        query with paginate_after, so no cursor is held between them.
+        Results must have an _id, so values() can't be used.
+        '''
+
+        while True:
+            page = list(self.clone().paginate_after(last_id, page_size))
+
+            if page:
+                yield page
+
+            if len(page) < page_size:
+                return
+
+            last = page[-1]
+            last_id = last['_id'] if isinstance(last, dict) else last._id
+
+    def _count_options(self):
+        kwargs = {}
+
+        for option in ('skip', 'limit'):
+            if self._options.get(option):
+                kwargs[option] = abs(self._options[option])
+
+        return kwargs
+
+    def count(self):
+        '''Counts the matching documents, honoring limit and skip.'''
+
+        collection = self._cls._get_collection(self._read_preference)
+
+        return collection.count_documents(self._spec or {},
+                                          **self._count_options())
+
+    async def acount(self):
+        pref = self._read_preference
+        collection = self._cls._get_collection(pref, asynchronous=True)
+
+        return await collection.count_documents(self._spec or {},
+                                                **self._count_options())
+
+    def clone(self):
+        '''Returns an unstarted copy of this QuerySet.'''
+
+        qs = QuerySet(self._cls, self._spec, self._projection,
+                      self._read_preference, **self._options)
+        qs._row = self._row
+        qs._prefetch = self._prefetch
+        qs._lazy = self._lazy
+
+        return qs
+
+
+class Aggregation(object):
+    '''
+    Builder of aggregation pipelines over the collection of a Model, which
+    run on the server and are iterated (also with async for) like a
+    QuerySet. Stages refer to fields by name, and naming a field that the
+    documents don't have at that point of the pipeline raises
+    MangaException.
+
+    Results are plain dicts, or with typed(), have the values that still
+    come from model fields converted by them, as when read from a model,
+    and the documents joined by lookup() built as instances of their model.
+    '''
+
+    def __init__(self, cls, pipeline=None):
+        self._cls = cls
+        self.pipeline = []
+        self._options = {}
+        self._typed = False
+        self._cursor = None
+
+        # Field names the documents have at the end of the pipeline, and
+        # converters for the values (and the list items) of some of them.
+        self._names = set(cls._fields)
+        self._converters = {}
+        self._items = {}
+
+        for fname, field in cls._fields.items():
+            if not field.lazy:
+                self._converters[fname] = field.to_python
+
+            item = getattr(field, 'field', None)
+
+            if isinstance(field, ListField) and item and not item.lazy:
+                self._items[fname] = item.to_python
+
+        for stage in pipeline or []:
+            self.stage(stage)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._cursor is None:
+            collection = self._cls._get_collection()
+            self._cursor = collection.aggregate(self.pipeline, **self._options)
+
+        return self._decode(next(self._cursor))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._cursor is None:
+            collection = self._cls._get_collection(asynchronous=True)
+            self._cursor = await collection.aggregate(self.pipeline,
+                                                      **self._options)
+
+        return self._decode(await self._cursor.next())
+
+    def _decode(self, son):
+        if not self._typed:
+            return son
+
+        for key, value in son.items():
+            if key in self._converters and value is not None:
+                son[key] = self._converters[key](value)
+
+        return son
+
+    def _check(self, path):
+        if self._names is not None and path.split('.')[0] not in self._names:
+            msg = '%s: no field %s at this point of the aggregation.'
+
+            raise MangaException(msg % (self._cls.__name__, path))
+
+    def _check_expression(self, expression):
+        '''Checks the field paths, like '$name', used in an expression.'''
+
+        if isinstance(expression, str):
+            if expression.startswith('$') and \
+                    not expression.startswith('$$'):
+                self._check(expression[1:])
+
+        elif isinstance(expression, dict):
+            for value in expression.values():
+                self._check_expression(value)
+
+        elif isinstance(expression, list):
+            for value in expression:
+                self._check_expression(value)
+
+    def _check_spec(self, spec):
+        '''Checks the field names used in a query.'''
+
+        for key, value in spec.items():
+            if key == '$expr':
+                self._check_expression(value)
+
+            elif key in ('$and', '$or', '$nor'):
+                for subspec in value:
+                    self._check_spec(subspec)
+
+            elif not key.startswith('$'):
+                self._check(key)
+
+    def _add(self, stage):
+        if self._cursor is not None:
+            raise InvalidOperation('Aggregation already started.')
+
+        self.pipeline.append(stage)
+
+        return self
+
+    def _reshaped(self, names, converters):
+        self._names = None if names is None else set(names)
+        self._converters = converters
+        self._items = dict((x, v) for x, v in self._items.items()
+                           if x in converters)
+
+    def stage(self, stage):
+        '''
+        Adds a stage as given, a dict in pymongo terms. Field names are not
+        checked anymore after stages other than $match, $sort, $limit and
+        $skip, since the documents they produce are not known.
+        '''
+
+        name = list(stage)[0] if len(stage) == 1 else None
+
+        if name == '$match':
+            self._check_spec(stage[name])
+
+        elif name == '$sort':
+            [self._check(x) for x in stage[name]]
+
+        elif name not in ('$limit', '$skip'):
+            self._names = None
+            self._converters = {}
+            self._items = {}
+
+        return self._add(stage)
+
+    def match(self, spec=None, **fields):
+        '''Filters the documents with a query, as given to find.'''
+
+        spec = dict(spec or {}, **fields)
+        self._check_spec(spec)
+
+        return self._add({'$match': spec})
+
+    def group(self, key=None, **accumulators):
+        '''
+        Groups the documents by key, a field name, an expression or None
+        for a single group, into documents with the key as _id and the
+        given accumulators, like total={'$sum': '$views'}.
+        '''
+
+        if isinstance(key, str) and not key.startswith('$'):
+            key = '$%s' % key
+
+        self._check_expression(key)
+
+        group = {'_id': key}
+        converters = {}
+        simple = isinstance(key, str) and key.startswith('$')
+
+        if simple and key[1:] in self._converters:
+            converters['_id'] = self._converters[key[1:]]
+
+        for name, expression in accumulators.items():
+            self._check_expression(expression)
+            group[name] = expression
+
+            # These pick a value of the field, which keeps its type.
+            for operator in ('$first', '$last', '$min', '$max'):
+                value = expression.get(operator)
+
+                if isinstance(value, str) and value[1:] in self._converters:
+                    converters[name] = self._converters[value[1:]]
+
+        self._reshaped(group, converters)
+
+        return self._add({'$group': group})
+
+    def project(self, *fields, **expressions):
+        '''
+        Reshapes the documents, keeping the given fields and adding the
+        given expressions, like total={'$add': ['$a', '$b']}. Fields can be
+        left out with expressions set to 0 instead.
+        '''
+
+        projection = dict((x, 1) for x in fields)
+        projection.update(expressions)
+
+        for name, expression in projection.items():
+            if expression in (0, 1, True, False):
+                self._check(name)
+
+            else:
+                self._check_expression(expression)
+
+        excluded = [x for x, v in projection.items() if v in (0, False)]
+
+        if len(excluded) == len(projection):
+            names = None if self._names is None else \
+                self._names - set(excluded)
+            kept = [x for x in self._converters if x not in excluded]
+
+        else:
+            # Fields kept as they are keep their converters.
+            kept = [x for x, v in projection.items() if v in (1, True)]
+            names = set(x.split('.')[0] for x in projection
+                        if x not in excluded)
+
+            if '_id' not in projection:
+                kept.append('_id')
+                names.add('_id')
+
+        self._reshaped(names, dict((x, self._converters[x]) for x in kept
+                                   if x in self._converters))
+
+        return self._add({'$project': projection})
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+
+        [self._check(x) for x, _ in key_or_list]
+
+        return self._add({'$sort': dict(key_or_list)})
+
+    def limit(self, limit):
+        return self._add({'$limit': limit})
+
+    def skip(self, skip):
+        return self._add({'$skip': skip})
+
+    def unwind(self, path, preserve_empty=False):
+        '''Turns each document into one per item of the list at path.'''
+
+        self._check(path)
+
+        stage = {'path': '$%s' % path}
+
+        if preserve_empty:
+            stage['preserveNullAndEmptyArrays'] = True
+
+        self._converters.pop(path, None)
+
+        if path in self._items:
+            self._converters[path] = self._items.pop(path)
+
+        return self._add({'$unwind': stage})
+
+    def lookup(self, fname, as_field=None):
+        '''
+        Joins the documents referred to by fname, a ReferenceField or a
+        ListField of them, as a list in as_field (fname by default).
+        '''
+
+        field = self._cls._fields.get(fname)
+        reference = getattr(field, 'field', field)
+
+        if not isinstance(reference, ReferenceField):
+            msg = '%s: %s is not a reference field.'
+
+            raise MangaException(msg % (self._cls.__name__, fname))
+
+        self._check(fname)
+
+        model = reference.model
+        as_field = as_field or fname
+        lookup = {'from': model._collection, 'localField': fname,
+                  'foreignField': '_id', 'as': as_field}
+
+        if self._names is not None:
+            self._names.add(as_field)
+
+        self._converters[as_field] = \
+            lambda sons: [model._from_db(x) for x in sons]
+        self._items[as_field] = model._from_db
+
+        return self._add({'$lookup': lookup})
+
+    def allow_disk_use(self, allow=True):
+        '''Lets stages that go over memory limits use temporary files.'''
+
+        self._options['allowDiskUse'] = allow
+
+        return self
+
+    def batch_size(self, batch_size):
+        self._options['batchSize'] = batch_size
+
+        return self
+
+    def typed(self):
+        '''Converts the values of model fields in the results.'''
+
+        self._typed = True
+
+        return self
+
+
+class Model(Document, metaclass=ModelType):
+    '''Base class for all classes.'''
+
+    __slots__ = ()
+
+    # The _id field is required, nevertheless its blank attribute is True.
+    # The _id is automatically generated by MongoDB, and doesn't need to be
+    # provided.
+    _id = Field(blank=True)
+
+    # Alias of the connection (see setup) holding the collection.
+    _database = 'default'
+
+    # Indexes besides those declared in fields, see ModelType.collect_indexes.
+    _indexes = []
+
+    # Cache for find_one by _id, see Cache.
+    _cache = None
+
+    @classmethod
+    def _get_collection(cls, read_preference=None, write_concern=None,
+                        asynchronous=False):
+        '''
+        Returns the pymongo collection of the model, with the given read
+        preference or write concern (a WriteConcern or a dict of its
+        arguments, like {'w': 'majority'}) instead of the client ones. With
+        asynchronous, the collection is an asyncio one.
+        '''
+
+        if cls._database not in _databases:
+            msg = 'Connection %s was not set up.'
+
+            raise MangaException(msg % cls._database)
+
+        if asynchronous:
+            database = _async_database(cls._database)
+
+        else:
+            database = _databases[cls._database]
+
+        collection = database[cls._collection]
+
+        if isinstance(write_concern, dict):
+            write_concern = WriteConcern(**write_concern)
+
+        if read_preference is not None or write_concern is not None:
+            collection = collection.with_options(
+                read_preference=read_preference, write_concern=write_concern)
+
+        return collection
+
+    @classmethod
+    def ensure_indexes(cls, drop=False):
+        '''
+        Creates the declared indexes missing from the collection, and
+        returns an IndexReport. Indexes that differ from their declaration
+        or are not declared are only reported, unless drop is given, in
+        which case the former are recreated and the latter dropped.
+        '''
+
+        collection = cls._get_collection()
+        existing = collection.index_information()
+        report = IndexReport()
+        missing = []
+
+        for model in cls._index_models:
+            name = model.document['name']
+
+            if name not in existing:
+                missing.append(model)
+
+            elif not _same_index(existing[name], model.document):
+                report.changed.append(name)
+
+                if drop:
+                    collection.drop_index(name)
+                    missing.append(model)
+
+        declared = set(x.document['name'] for x in cls._index_models)
+        report.extra = [x for x in existing
+                        if x not in declared and x != '_id_']
+
+        if drop:
+            for name in report.extra:
+                collection.drop_index(name)
+
+        if missing:
+            report.created = collection.create_indexes(missing)
+
+        return report
+
+    @classmethod
+    def find(cls, *args, **kwargs):
+        return QuerySet(cls, *args, **kwargs)
+
+    @classmethod
+    def aggregate(cls, pipeline=None):
+        '''
+        Returns an Aggregation over the collection, to be built with its
+        methods, starting with the stages of pipeline if given.
+        '''
+
+        return Aggregation(cls, pipeline)
+
+    @classmethod
+    def watch(cls, pipeline=None, resume_after=None, wait=None):
+        '''
+        Yields a Change for every document of the collection inserted,
+        updated, replaced or deleted from now on, or after the change with
+        the token resume_after, from a MongoDB change stream (which needs a
+        replica set). The changed documents are dropped from the cache.
+
+        pipeline adds stages filtering the change events. With wait, in
+        seconds, None is yielded whenever no change came in that time, so
+        the caller gets a chance to stop.
+        '''
+
+        kwargs = {'full_document': 'updateLookup',
+                  'resume_after': resume_after}
+
+        if wait is not None:
+            kwargs['max_await_time_ms'] = int(wait * 1000)
+
+        with cls._get_collection().watch(pipeline, **kwargs) as stream:
+            # Without wait, the stream blocks until a change comes in.
+            if wait is None:
+                for event in stream:
+                    yield cls._change(event)
+
+                return
+
+            while stream.alive:
+                event = stream.try_next()
+                yield None if event is None else cls._change(event)
+
+    @classmethod
+    def _change(cls, event):
+        operation = event['operationType']
+        _id = event.get('documentKey', {}).get('_id')
+        son = event.get('fullDocument')
+
+        if operation in _document_changes:
+            cls._forget(_id)
+
+        else:
+            cls._forget()
+
+        obj = None if son is None else cls._from_db(son)
+
+        return Change(operation, _id, obj, event['_id'])
+
+    @classmethod
+    def _key(cls, _id):
+        '''Key of the document with _id in identity maps and caches.'''
+
+        return (cls._database, cls._collection, _id)
+
+    @classmethod
+    def _lookup_key(cls, spec, args, kwargs):
+        '''Key for a find_one with spec, if it just gets a document by _id.'''
+
+        if args or kwargs or spec is None or list(spec) != ['_id']:
+            return None
+
+        if isinstance(spec['_id'], (dict, list)):
+            return None
+
+        return cls._key(spec['_id'])
+
+    @classmethod
+    def _cached(cls, key):
+        '''Gets the instance for key from the identity map or the cache.'''
+
+        imap = _identity_map.get()
+        obj = None if imap is None else imap.get(key)
+
+        if obj is None and cls._cache is not None:
+            son = cls._cache.get(key)
+
+            if son is not None:
+                obj = cls._from_db(deepcopy(son))
+
+                if imap is not None:
+                    obj = imap.add(key, obj)
+
+        return obj
+
+    @classmethod
+    def _fetched(cls, key, obj):
+        if cls._cache is not None:
+            cls._cache.set(key, deepcopy(dict(obj._data)))
+
+    @classmethod
+    def _forget(cls, *ids):
+        '''
+        Drops the documents with the given ids from the identity map and
+        the cache, or all the documents of the model if no id is given.
+        '''
+
+        imap = _identity_map.get()
+        caches = [x for x in (imap, cls._cache) if x is not None]
+
+        for cache in caches:
+            if not ids:
+                cache.clear((cls._database, cls._collection))
+
+            for _id in ids:
+                cache.discard(cls._key(_id))
+
+    def _remember(self):
+        '''Makes this the instance of its document in the identity map.'''
+
+        imap = _identity_map.get()
+
+        if imap is not None and self._loaded is None:
+            imap.add(self._key(self._id), self)
+
+    @classmethod
+    def _written(cls, spec):
+        '''Forgets the cached documents that writing to spec may change.'''
+
+        if cls._lookup_key(spec, (), {}) is not None:
+            cls._forget(spec['_id'])
+
+        else:
+            cls._forget()
+
+    @classmethod
+    @_instrumented('find_one', query=True)
+    def find_one(cls, spec=None, *args, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        key = cls._lookup_key(spec, args, kwargs)
+        obj = None if key is None else cls._cached(key)
+
+        if obj is not None:
+            return obj
+
+        for obj in cls.find(spec, *args, **kwargs).limit(-1):
+            if key is not None:
+                cls._fetched(key, obj)
+
+            return obj
+
+        return None
+
+    @classmethod
+    def afind(cls, *args, **kwargs):
+        '''Same as find, for iterating with async for.'''
+
+        return cls.find(*args, **kwargs)
+
+    @classmethod
+    @_instrumented('find_one', query=True)
+    async def afind_one(cls, spec=None, *args, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        key = cls._lookup_key(spec, args, kwargs)
+        obj = None if key is None else cls._cached(key)
+
+        if obj is not None:
+            return obj
+
+        async for obj in cls.find(spec, *args, **kwargs).limit(-1):
+            if key is not None:
+                cls._fetched(key, obj)
+
+            return obj
+
+        return None
+
+    @classmethod
+    def split_ranges(cls, splits, spec=None):
+        '''
+        Splits the documents matching spec in up to splits ranges of _id of
+        about the same size, as (lower, upper) pairs, where lower is
+        included, upper is not, and None stands for no bound.
+        '''
+
+        bucket = {'groupBy': '$_id', 'buckets': splits}
+        pipeline = [{'$match': spec or {}}, {'$bucketAuto': bucket}]
+        buckets = list(cls._get_collection().aggregate(pipeline))
+        bounds = [None] + [x['_id']['min'] for x in buckets[1:]] + [None]
+
+        return list(zip(bounds, bounds[1:]))
+
+    @classmethod
+    def parallel_scan(cls, callback, workers=4, spec=None, splits=None,
+                      batch_size=1000, processes=False, checkpoint=None):
+        '''
+        Calls callback with lists of up to batch_size of the documents
+        matching spec, from workers threads scanning ranges of _id at the
+        same time (see split_ranges, by default 4 per worker). Returns how
+        many documents were scanned.
+
+        With processes, the ranges are scanned by worker processes instead,
+        for CPU bound callbacks, which then must be module level functions,
+        like the model.
+
+        With checkpoint, a file path, the progress is saved there as the
+        scan goes, and running the scan again after it failed resumes it.
+        The file is removed when the scan completes. With processes, ranges
+        are only saved as done once scanned in full.
+        '''
+
+        state = _load_checkpoint(checkpoint)
+
+        if state is None:
+            ranges = cls.split_ranges(splits or workers * 4, spec)
+            state = {'ranges': [list(x) for x in ranges], 'done': [],
+                     'after': {}}
+
+        lock = Lock()
+
+        def progress(index, last_id):
+            with lock:
+                if last_id is None:
+                    state['done'].append(index)
+                    state['after'].pop(str(index), None)
+
+                else:
+                    state['after'][str(index)] = last_id
+
+                _save_checkpoint(checkpoint, state)
+
+        settings = None
+
+        if processes:
+            database = _databases[cls._database]
+            settings = (database.name,) + _settings[cls._database]
+            pool = ProcessPoolExecutor(workers)
+
+        else:
+            pool = ThreadPoolExecutor(workers)
+
+        futures = {}
+        count = 0
+
+        with pool:
+            for index, (lower, upper) in enumerate(state['ranges']):
+                if index in state['done']:
+                    continue
+
+                after = state['after'].get(str(index))
+                report = None
+
+                if checkpoint is not None and not processes:
+                    report = lambda x, index=index: progress(index, x)
+
+                future = pool.submit(_scan_range, cls, spec, lower, upper,
+                                     after, batch_size, callback, report,
+                                     settings)
+                futures[future] = index
+
+            try:
+                for future in as_completed(futures):
+                    count += future.result()
+
+                    if checkpoint is not None:
+                        progress(futures[future], None)
+
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+
+                raise
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        return count
+
+    @classmethod
+    def _from_db(cls, son, loaded=None):
+        obj = cls._from_son(son, loaded)
+        obj._persisted = True
+
+        # Compact documents copy son into their slots, leaving it as it was.
+        if type(son) is dict:
+            obj._stored = son if obj._compact else dict(son)
+
+        return obj
+
+    @classmethod
+    @_instrumented('remove', query=True)
+    def remove(cls, spec=None, write_concern=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        collection = cls._get_collection(write_concern=write_concern)
+        result = collection.delete_many(spec or {}, **kwargs)
+        cls._written(spec)
+
+        return result
+
+
+    @_instrumented('delete')
+    def delete(self, write_concern=None):
+        if self._id:
+            collection = self._get_collection(write_concern=write_concern)
+            collection.delete_one({'_id': self._id})
+            self._forget(self._id)
+
+            self._id = None
+            self._persisted = False
+
+        else:
+            raise Exception
+
+    @classmethod
+    @_instrumented('remove', query=True)
+    async def aremove(cls, spec=None, write_concern=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        collection = cls._get_collection(write_concern=write_concern,
+                                         asynchronous=True)
+
+        result = await collection.delete_many(spec or {}, **kwargs)
+        cls._written(spec)
+
+        return result
+
+    @_instrumented('delete')
+    async def adelete(self, write_concern=None):
+        if self._id:
+            collection = self._get_collection(write_concern=write_concern,
+                                              asynchronous=True)
+            await collection.delete_one({'_id': self._id})
+            self._forget(self._id)
+
+            self._id = None
+            self._persisted = False
+
+        else:
+            raise Exception
+
+    @classmethod
+    def _operand(cls, operator, path, value):
+        '''
+        Validates and converts the operand of an update operator on path
+        through its field. Paths into embedded documents are only checked
+        up to the field holding them.
+        '''
+
+        fname = path.split('.', 1)[0]
+        field = cls._fields.get(fname)
+
+        if field is None:
+            msg = '%s: there is no field %s.'
+
+            raise MangaException(msg % (cls.__name__, fname))
+
+        if '.' in path:
+            return value
+
+        # The operands of list operators are items of the list.
+        if operator in ('push', 'pull', 'add_to_set'):
+            if not isinstance(field, ListField):
+                msg = "%s: can't %s on %s, which is not a list."
+
+                raise MangaException(msg % (cls.__name__, operator, fname))
+
+            if field.field is None:
+                return value
+
+            field = field.field
+
+        try:
+            if operator == 'inc':
+                assert isinstance(value, (int, float))
+                assert not isinstance(value, bool)
+
+                return value
+
+            # Blank fields may be missing, whatever their type.
+            if operator == 'unset':
+                assert field.blank
+
+                return ''
+
+            field.validate(value)
+
+        except AssertionError:
+            raise ValidationError(cls.__name__, fname, value)
+
+        return field.to_storage(value)
+
+    @classmethod
+    def _update_document(cls, operations):
+        '''
+        Builds a pymongo update document out of operations given as keyword
+        arguments: set, unset (a list of field names), inc, push, pull and
+        add_to_set, each with a dict of operands by field.
+        '''
+
+        if not operations:
+            raise MangaException('No update operations given.')
+
+        update = {}
+
+        for operator, operands in operations.items():
+            if operator not in _update_operators:
+                raise MangaException('Unknown update operator %s.' % operator)
+
+            if operator == 'unset':
+                operands = dict((x, '') for x in operands)
+
+            update[_update_operators[operator]] = dict(
+                (path, cls._operand(operator, path, value))
+                for path, value in operands.items())
+
+        return update
+
+    @classmethod
+    @_instrumented('update', query=True)
+    def update(cls, spec, multi=False, upsert=False, write_concern=None,
+               **operations):
+        '''
+        Updates in place the stored document matching spec, or all of them
+        with multi, without reading them. Operations are given as keyword
+        arguments, as in Model.update({'_id': x}, inc={'views': 1}).
+        '''
+
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        update = cls._update_document(operations)
+        collection = cls._get_collection(write_concern=write_concern)
+
+        if multi:
+            result = collection.update_many(spec, update, upsert=upsert)
+
+        else:
+            result = collection.update_one(spec, update, upsert=upsert)
+
+        cls._written(spec)
+
+        return result
+
+    @classmethod
+    @_instrumented('update', query=True)
+    async def aupdate(cls, spec, multi=False, upsert=False,
+                      write_concern=None, **operations):
+        '''Same as update, for asyncio.'''
+
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        update = cls._update_document(operations)
+        collection = cls._get_collection(write_concern=write_concern,
+                                         asynchronous=True)
+
+        if multi:
+            result = await collection.update_many(spec, update, upsert=upsert)
+
+        else:
+            result = await collection.update_one(spec, update, upsert=upsert)
+
+        cls._written(spec)
+
+        return result
+
+    @classmethod
+    def _found_and_updated(cls, son, new):
+        if son is None:
+            return None
+
+        cls._forget(son['_id'])
+
+        obj = cls._from_db(son)
+
+        # The document as it was before the update is already stale.
+        if new:
+            obj._remember()
+
+        return obj
+
+    @classmethod
+    @_instrumented('find_one_and_update', query=True)
+    def find_one_and_update(cls, spec, new=True, sort=None, upsert=False,
+                            write_concern=None, **operations):
+        '''
+        Updates a stored document like update, and returns it as a model
+        instance, as it is after the update or before it if new is False.
+        '''
+
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        update = cls._update_document(operations)
+        collection = cls._get_collection(write_concern=write_concern)
+        after = ReturnDocument.AFTER if new else ReturnDocument.BEFORE
+        son = collection.find_one_and_update(spec, update, sort=sort,
+                                             upsert=upsert,
+                                             return_document=after)
+
+        return cls._found_and_updated(son, new)
+
+    @classmethod
+    @_instrumented('find_one_and_update', query=True)
+    async def afind_one_and_update(cls, spec, new=True, sort=None,
+                                   upsert=False, write_concern=None,
+                                   **operations):
+        '''Same as find_one_and_update, for asyncio.'''
+
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+
+        update = cls._update_document(operations)
+        collection = cls._get_collection(write_concern=write_concern,
+                                         asynchronous=True)
+        after = ReturnDocument.AFTER if new else ReturnDocument.BEFORE
+        son = await collection.find_one_and_update(spec, update, sort=sort,
+                                                   upsert=upsert,
+                                                   return_document=after)
+
+        return cls._found_and_updated(son, new)
+
+    @_instrumented('update')
+    def _atomic(self, operator, fname, operand, write_concern=None):
+        '''
+        Applies an update operator to a field of this stored document, and
+        to the instance: the field gets the value now stored, or keeps its
+        unsaved changes with the operator applied to them too.
+        '''
+
+        if not self._persisted:
+            msg = "%s: can't %s on a document that is not stored."
+
+            raise MangaException(msg % (self.__class__.__name__, operator))
+
+        # Only whole fields can be brought up to date on the instance.
+        if '.' in fname:
+            msg = "%s: can't %s on %s, which is not a field."
+
+            raise MangaException(msg % (self.__class__.__name__, operator,
+                                        fname))
+
+        update = self._update_document({operator: {fname: operand}})
+        collection = self._get_collection(write_concern=write_concern)
+        son = collection.find_one_and_update(
+            {'_id': self._id}, update, projection={fname: 1},
+            return_document=ReturnDocument.AFTER)
+
+        if son is None:
+            msg = '%s: document %s is not stored anymore.'
+
+            raise MangaException(msg % (self.__class__.__name__, self._id))
+
+        self._forget(self._id)
+        self._remember()
+
+        # Changes made in place to the converted value count as unsaved.
+        self._flush()
+
+        stored = son.get(fname)
+        value = self._data.get(fname)
+
+        if fname in self._original and _kept(self._original[fname]) != value:
+            operand = list(update.values())[0][fname]
+            self._data[fname] = _apply_update(operator, value, operand)
+
+        else:
+            self._data[fname] = stored
+
+        if fname in self._original:
+            self._original[fname] = _copy(stored, fname)
+
+        # So that saving doesn't take the new value for a change of its own.
+        kept = self._stored
+
+        if kept is None and type(self._data) is _RawData:
+            kept = self._data.stored()
+
+        if kept is not None:
+            kept[fname] = stored
+
+        if fname in self._converted:
+            del self._converted[fname]
+
+        if self._loaded is not None:
+            self._loaded = self._loaded | set([fname])
+
+    def inc(self, fname, amount=1, write_concern=None):
+        '''Increments a field of the stored document by amount.'''
+
+        self._atomic('inc', fname, amount, write_concern)
+
+    def push(self, fname, item, write_concern=None):
+        '''Appends item to a list field of the stored document.'''
+
+        self._atomic('push', fname, item, write_concern)
+
+    def pull(self, fname, item, write_concern=None):
+        '''Removes item from a list field of the stored document.'''
+
+        self._atomic('pull', fname, item, write_concern)
+
+    def add_to_set(self, fname, item, write_concern=None):
+        '''Appends item to a list field of the stored document if missing.'''
+
+        self._atomic('add_to_set', fname, item, write_concern)
+
+    @classmethod
+    @_instrumented('save_many')
+    def save_many(cls, documents, batch_size=1000, ordered=False,
+                  write_concern=None, raw=False):
+        '''
+        Saves documents in batches of bulk writes, with the same semantics as
+        calling save on each of them. Documents that fail validation or
+        clean, with whatever error, and failed writes are reported in the
+        returned BulkResult instead of aborting the whole run, unless ordered
+        is given, in which case nothing is written after the first failure.
+        raw is like in save.
+        '''
+
+        result = BulkResult()
+        batch = []
+
+        for doc in documents:
+            try:
+                doc._before_save()
+
+            except Exception as exc:
+                result.errors.append((doc, exc))
+
+                if ordered:
+                    # Documents queued ahead of the failure are still
+                    # written, as they would be by separate saves.
+                    if batch:
+                        cls._save_batch(batch, ordered, write_concern,
+                                        result, raw)
+
+                    return result
+
+                continue
+
+            batch.append(doc)
+
+            if len(batch) == batch_size:
+                saved = cls._save_batch(batch, ordered, write_concern,
+                                        result, raw)
+
+                if not saved and ordered:
+                    return result
+
+                batch = []
+
+        if batch:
+            cls._save_batch(batch, ordered, write_concern, result, raw)
+
+        return result
+
+    @classmethod
+    def _save_batch(cls, batch, ordered, write_concern, result, raw=False):
+        '''Writes an already validated batch, returns False on failures.'''
+
+        docs, ops, inserted = [], [], set()
+        refused = False
+
+        for doc in batch:
+            try:
+                mode = doc._save_mode()
+
+            except MangaException as exc:
+                result.errors.append((doc, exc))
+                refused = True
+
+                if ordered:
+                    break
+
+                continue
+
+            if mode == 'update':
+                changes = doc._changes()
+
+                if not changes:
+                    doc._saved()
+                    result.saved.append(doc)
+
+                    continue
+
+                ops.append(UpdateOne({'_id': doc._id}, changes))
+
+            elif mode == 'replace':
+                document = doc.to_bson() if raw else doc._data
+                ops.append(ReplaceOne({'_id': doc._id}, document, upsert=True))
+
+            else:
+                # Generating the _id here lets us hand it back to the
+                # document without depending on what the driver reports.
+                doc._data['_id'] = ObjectId()
+                ops.append(InsertOne(doc.to_bson() if raw else doc._data))
+                inserted.add(doc)
+
+            docs.append(doc)
+
+        if not ops:
+            return not refused
+
+        failed = {}
+
+        try:
+            collection = cls._get_collection(write_concern=write_concern)
+            collection.bulk_write(ops, ordered=ordered)
+
+        except BulkWriteError as exc:
+            for error in exc.details.get('writeErrors', []):
+                err = WriteError(error.get('errmsg'), error.get('code'), error)
+                failed[error['index']] = err
+
+        # When ordered, nothing after the first failure was written.
+        last = min(failed) if failed and ordered else len(docs)
+
+        for index, doc in enumerate(docs):
+            if index in failed:
+                result.errors.append((doc, failed[index]))
+
+            elif index < last:
+                doc._saved()
+                result.saved.append(doc)
+
+            if doc in inserted and (index in failed or index >= last):
+                doc._data['_id'] = None
+
+                if '_id' in doc._converted:
+                    del doc._converted['_id']
+
+        return not failed and not refused
+
+    def _before_save(self):
+        start = perf_counter()
+        self._flush()
+        self._track()
+
+        for fieldname, fieldinstance in self._pre_save_fields:
+            value = fieldinstance.pre_save_val()
+
+            if value:
+                setattr(self, fieldname, value)
+
+        # Values assigned through the fields were validated then, and
+        # mutable ones are validated again as they may have changed since.
+        self.validate(self._validated())
+        self.clean()
+        self._valid = dict(self._data)
+
+        operation = _operation.get()
+
+        if operation is not None:
+            operation.validate_time += perf_counter() - start
+
+    def to_bson(self):
+        '''
+        Returns the stored data encoded as a RawBSONDocument, with the
+        fields in the order of the class, which pymongo writes as it is
+        instead of encoding it again.
+        '''
+
+        data = self._data
+
+        if tuple(data) != self._layout:
+            son = dict((x, data[x]) for x in self._layout if x in data)
+            son.update(data)
+            data = son
+
+        return RawBSONDocument(encode(data), _raw_options)
+
+    def _save_mode(self, full=False):
+        '''
+        Tells how the document has to be written: 'insert' for documents
+        without an _id, 'update' for documents already stored, and 'replace'
+        otherwise.
+        '''
+
+        # Changing the _id means writing a different document.
+        moved = self._original.get('_id', self._id) != self._id
+
+        if not self._id:
+            mode = 'insert'
+
+        elif self._persisted and not full and not moved:
+            mode = 'update'
+
+        else:
+            mode = 'replace'
+
+        if self._loaded is not None and mode != 'update':
+            msg = "%s: can't %s a partially loaded document."
+
+            raise MangaException(msg % (self.__class__.__name__, mode))
+
+        return mode
 
+    def _saved(self):
+        # Inserting sets the _id straight into the stored data.
+        if '_id' in self._converted:
+            del self._converted['_id']
 
-def setup(database_name):
-    global db, connection, _manipulators
+        self._forget(self._original.get('_id', self._id), self._id)
+        self._remember()
+        self._sync()
+        self._persisted = True
+        self._stored = dict(self._data)
 
-    if db:
-        raise Exception('Module was already configured.')
+    @_instrumented('save')
+    def save(self, full=False, write_concern=None, raw=False):
+        '''
+        Stores the document. New documents are inserted, and documents that
+        were loaded or saved before only get the fields that changed since
+        then updated, unless full is given, which replaces the whole stored
+        document. With raw, whole documents are handed to pymongo encoded
+        by to_bson.
+        '''
 
-    connection = MongoClient('localhost', 27017, tz_aware=True)
-    db = getattr(connection, database_name)
+        self._before_save()
 
-    for x in _manipulators:
-        db.add_son_manipulator(x)
+        collection = self._get_collection(write_concern=write_concern)
+        mode = self._save_mode(full)
 
-    return db
+        if mode == 'update':
+            changes = self._changes()
 
+            if changes:
+                collection.update_one({'_id': self._id}, changes)
 
-class UTC(tzinfo):
-    def utcoffset(self, dt):
-        return timedelta(0)
+        elif mode == 'replace':
+            document = self.to_bson() if raw else self._data
+            collection.replace_one({'_id': self._id}, document, upsert=True)
 
-    def tzname(self, dt):
-        return "UTC"
+        elif raw:
+            self._data['_id'] = ObjectId()
+            collection.insert_one(self.to_bson())
 
-    def dst(self, dt):
-        return timedelta(0)
+        else:
+            del self._data['_id']
 
+            self._data['_id'] = collection.insert_one(self._data).inserted_id
 
-class _ModelManipulator(SONManipulator):
-    '''
-    Generates on-the-fly manipulators for newly registered models. Keeps track
-    of collections already registered, to avoid double registration.
-    '''
+        self._saved()
 
-    _M01 = "Manipulator for collection %s was already defined."
-    registered_collections = []
+    @_instrumented('save')
+    async def asave(self, full=False, write_concern=None, raw=False):
+        '''Same as save, for asyncio.'''
 
-    def __init__(self, cls):
-        self.cls = cls
-        self.cls_name = cls.__name__.lower()
+        self._before_save()
 
-        if self.cls_name in self.registered_collections:
-            raise Exception(self._M01 % self.cls_name)
+        collection = self._get_collection(write_concern=write_concern,
+                                          asynchronous=True)
+        mode = self._save_mode(full)
 
-        else:
-            self.registered_collections.append(self.cls_name)
+        if mode == 'update':
+            changes = self._changes()
+
+            if changes:
+                await collection.update_one({'_id': self._id}, changes)
 
-    def transform_outgoing(self, son, collection):
-        if son and self.cls_name == collection.name:
-            return self.cls(son=son)
+        elif mode == 'replace':
+            document = self.to_bson() if raw else self._data
+            await collection.replace_one({'_id': self._id}, document,
+                                         upsert=True)
+
+        elif raw:
+            self._data['_id'] = ObjectId()
+            await collection.insert_one(self.to_bson())
 
         else:
-            return son
+            del self._data['_id']
 
+            result = await collection.insert_one(self._data)
+            self._data['_id'] = result.inserted_id
 
-class MangaException(Exception):
-    pass
+        self._saved()
 
-class ValidationError(MangaException):
-    def __init__(self, cls, attr, val):
-        self.cls = cls
-        self.attr = attr
-        self.val = val
 
-    def __str__(self):
-        return "%s: trying to set %s <- %s" % (self.cls, self.attr, self.val)
+class TimeStampedModel(Model):
+    __slots__ = ()
 
-class DeserializationError(MangaException):
-    def __init__(self, field, val):
-        self.fld = field
-        self.val = val
+    created = DateTimeField(auto='created')
+    modified = DateTimeField(auto='modified')
 
-    def __str__(self):
-        msg = "Can't deserialize value for field %s: %s"
 
-        return "Can't deserialize field %s with %s" % (self.fld, self.val)
+class Change(object):
+    '''
+    A change from Model.watch: its operation ('insert', 'update',
+    'replace', 'delete', or for the whole collection 'drop', 'rename' or
+    'invalidate'), the _id of the document, the document as a model
+    instance after the change (None if deleted), and the token to resume
+    watching after it.
+    '''
 
+    def __init__(self, operation, _id, document, token):
+        self.operation = operation
+        self._id = _id
+        self.document = document
+        self.token = token
 
-class ModelType(type):
-    """
-    This is a type that generates Model classes properly, setting their
-    attributes not to be instances of Field, but rather an API for MongoDB
-    itself.
-    """
+    def __repr__(self):
+        return '<Change %s %r>' % (self.operation, self._id)
 
-    @staticmethod
-    def get_maker(attr):
-        def getter(cls, attr=attr):
-            return cls._fields[attr].to_python(cls._data.get(attr))
 
-        return getter
+class View(Mapping):
+    '''
+    The documents of a model, as instances by _id or by the value of the
+    field key, read once by start() and then kept up to date by a thread
+    watching the collection, until stop(). Looking them up never goes to
+    the database. If watching fails, the exception is kept in error and
+    the view stops changing.
+    '''
 
-    @staticmethod
-    def set_maker(attr):
-        def setter(cls, val=None, attr=attr):
-            try:
-                cls._fields[attr].validate(val)
+    def __init__(self, model, key='_id', wait=0.5):
+        self.model = model
+        self.key = key
+        self.wait = wait
+        self.error = None
+        self._items = {}
+        self._keys = {}
+        self._lock = Lock()
+        self._ready = Event()
+        self._stopped = Event()
+        self._thread = None
 
-            except AssertionError:
-                raise ValidationError(cls.__class__.__name__, attr, val)
+    def __getitem__(self, key):
+        return self._items[key]
 
-            else:
-                cls._data[attr] = cls._fields[attr].to_storage(val)
+    def __iter__(self):
+        return iter(list(self._items))
 
-        return setter
+    def __len__(self):
+        return len(self._items)
 
-    def __new__(cls, name, bases, dct):
-        dct.setdefault('_fields', {})
-        dct.setdefault('_collection', name.lower())
+    def __enter__(self):
+        return self.start()
 
-        for x in bases:
-            dct['_fields'].update(getattr(x, '_fields', {}))
+    def __exit__(self, *args):
+        self.stop()
 
-        for attr, val in list(dct.items()):
-            if isinstance(val, Field):
-                dct['_fields'][attr] = val
-                dct[attr] = property(cls.get_maker(attr), cls.set_maker(attr))
+    def start(self):
+        '''Reads the documents and starts watching for their changes.'''
 
-        rich_cls = super(ModelType, cls).__new__(cls, name, bases, dct)
+        self._stopped.clear()
+        self._ready.clear()
+        self._thread = Thread(target=self._watch, daemon=True)
+        self._thread.start()
+        self._ready.wait()
 
-        if any([hasattr(x, 'save') for x in bases]):
-            if db:
-                db.add_son_manipulator(_ModelManipulator(rich_cls))
+        if self.error is not None:
+            raise self.error
 
-            else:
-                _manipulators.append(_ModelManipulator(rich_cls))
+        return self
 
-        return rich_cls
+    def stop(self):
+        self._stopped.set()
 
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
-class Field(object):
-    '''Base field for all fields.'''
+    def reload(self):
+        items = {}
+        keys = {}
 
-    def __init__(self, default=None, blank=False):
-        self.blank = blank
-        self.default = default
+        for obj in self.model.find():
+            items[getattr(obj, self.key)] = obj
+            keys[obj._id] = getattr(obj, self.key)
 
-    def validate(self, value):
-        if not self.blank:
-            assert value
+        with self._lock:
+            self._items, self._keys = items, keys
 
-    def pre_save_val(self):
-        return None
+    def apply(self, change):
+        '''Updates the view with a Change.'''
 
-    @staticmethod
-    def to_storage(value):
-        return value
+        if change.operation not in _document_changes:
+            # The whole collection changed: start over.
+            self.reload()
 
-    @staticmethod
-    def to_python(value):
-        return value
+            return
 
-class ObjectIdField(Field):
-    def validate(self, value):
-        assert isinstance(value, ObjectId)
+        with self._lock:
+            key = self._keys.pop(change._id, None)
+            self._items.pop(key, None)
 
-        if not self.blank:
-            assert value
+            if change.document is not None:
+                key = getattr(change.document, self.key)
+                self._items[key] = change.document
+                self._keys[change._id] = key
 
-class StringField(Field):
-    def __init__(self, default='', length=None, **kwargs):
-        super(StringField, self).__init__(default, **kwargs)
+    def _watch(self):
+        try:
+            while not self._stopped.is_set():
+                self._follow()
 
-        self.length = length
+        except Exception as e:
+            self.error = e
 
-    def validate(self, value):
-        assert isinstance(value, str)
+        finally:
+            self._ready.set()
 
-        if not self.blank:
-            assert value.strip()
+    def _follow(self):
+        '''Reads the documents and applies changes until the stream ends.'''
 
-        if self.length:
-            length = len(value.strip())
+        changes = self.model.watch(wait=self.wait)
 
-            assert length >= self.length[0] and length <= self.length[1]
+        try:
+            # The change stream is opened first, so that nothing changing
+            # while reading the documents is missed.
+            change = next(changes, None)
+            self.reload()
+            self._ready.set()
 
-    @staticmethod
-    def to_storage(value):
-        return value.strip()
+            while not self._stopped.is_set():
+                if change is not None:
+                    self.apply(change)
 
+                change = next(changes, _ended)
 
-class EmailField(StringField):
-    email_re = compile(r'^[\S]+@[\S]+\.[\S]+$')
+                if change is _ended:
+                    return
 
-    def __init__(self, default='', length=(5, 100), **kwargs):
-        super(EmailField, self).__init__(default, length, **kwargs)
+        finally:
+            changes.close()
 
-    def validate(self, value):
-        super(EmailField, self).validate(value)
 
-        if not self.email_re.match(value):
-            raise AssertionError
+def _scan_range(model, spec, lower, upper, after, batch_size, callback,
+                progress=None, settings=None):
+    '''
+    Scans the documents matching spec in a range of _id for parallel_scan,
+    from after on if given, and returns how many there were. With
+    settings, it runs in a worker process, which connects on its own.
+    '''
 
+    if settings is not None:
+        name, uri, kwargs = settings
+        setup(name, uri, alias=model._database, **kwargs)
 
-class DateTimeField(Field):
-    def __init__(self, default=None, blank=False, auto=None, **kwargs):
-        super(DateTimeField, self).__init__(default, blank, **kwargs)
+    bounds = {}
 
-        self.auto = auto
+    if lower is not None:
+        bounds['$gte'] = lower
 
-        if auto in ['modified', 'created']:
-            self.default = lambda: datetime.now(UTC())
+    if upper is not None:
+        bounds['$lt'] = upper
 
-    def validate(self, value):
-        super(DateTimeField, self).validate(value)
+    if bounds:
+        spec = {'$and': [spec, {'_id': bounds}]} if spec else {'_id': bounds}
 
-        assert (isinstance(value, datetime) and value.tzinfo) or value is None
+    count = 0
 
-    def pre_save_val(self):
-        return datetime.now(UTC()) if self.auto == 'modified' else None
+    for page in model.find(spec).pages(batch_size, after):
+        callback(page)
+        count += len(page)
 
-    @staticmethod
-    def to_storage(value):
-        return milli_trim(value) if value else None
+        if progress is not None:
+            progress(page[-1]._id)
 
+    return count
 
-class DictField(Field):
-    def __init__(self, default=None, **kwargs):
 
-        super(DictField, self).__init__(default or {}, **kwargs)
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return None
 
-    def validate(self, value):
-        assert isinstance(value, dict)
+    with open(path) as stream:
+        return json_util.loads(stream.read())
 
-        if not self.blank:
-            assert value != {}
 
+def _save_checkpoint(path, state):
+    '''Saves the state of a parallel_scan, replacing the file atomically.'''
 
-class DocumentField(Field):
-    def __init__(self, default=None, document=None, **kwargs):
-        super(DocumentField, self).__init__(default, **kwargs)
+    temporary = '%s.tmp' % path
 
-        self.document_class = document
+    with open(temporary, 'w') as stream:
+        stream.write(json_util.dumps(state))
 
-    def validate(self, value):
-        if not self.blank:
-            assert value
+    os.replace(temporary, path)
 
-        if value:
-            assert isinstance(value, self.document_class)
-            value.validate()
 
-        else:
-            assert value is None
+def _check_format(fmt):
+    if fmt not in ('ndjson', 'bson'):
+        raise MangaException('Unknown format %s, use ndjson or bson.' % fmt)
 
-    @staticmethod
-    def to_storage(value):
-        return getattr(value, '_data', None)
 
-    def to_python(self, value):
-        return self.document_class(son=value)
+def export_documents(model, stream, fmt='ndjson', spec=None,
+                     batch_size=1000):
+    '''
+    Writes the stored documents of model matching spec to stream, as lines
+    of MongoDB extended JSON (a text stream) or as BSON (a binary stream),
+    reading them in batches of batch_size. Returns how many were written.
+    '''
 
-class ListField(Field):
-    def __init__(self, default=None, field=None, **kwargs):
-        default = default or []
+    _check_format(fmt)
 
-        super(ListField, self).__init__(default, **kwargs)
+    collection = model._get_collection()
+    count = 0
 
-        self.field = field
+    # BSON is written as read, without decoding the documents at all.
+    if fmt == 'bson':
+        options = CodecOptions(document_class=RawBSONDocument)
+        collection = collection.with_options(codec_options=options)
 
-    def validate(self, value):
-        assert isinstance(value, list)
+    for son in collection.find(spec, batch_size=batch_size):
+        if fmt == 'bson':
+            stream.write(son.raw)
 
-        if not self.blank:
-            assert value
+        else:
+            # Canonical extended JSON keeps the BSON types, like Int64.
+            options = json_util.CANONICAL_JSON_OPTIONS
+            stream.write(json_util.dumps(son, json_options=options) + '\n')
 
-        [self.field.validate(v) for v in value if self.field]
+        count += 1
 
-    def to_storage(self, value):
-        if self.field:
-            return [self.field.to_storage(v) for v in value]
+    return count
 
-        else:
-            return value
 
-    def to_python(self, value):
-        if not isinstance(value, list):
-            raise DeserializationError(self, value)
+def _read_documents(stream, fmt):
+    '''Yields the documents written by export_documents to stream.'''
 
-        if self.field:
-            return [self.field.to_python(v) for v in value]
+    if fmt == 'bson':
+        options = CodecOptions(tz_aware=True, tzinfo=UTC())
 
-        else:
-            return value
+        for son in decode_file_iter(stream, options):
+            yield son
 
+    else:
+        options = json_util.JSONOptions(tz_aware=True, tzinfo=UTC())
 
-class Document(object, metaclass=ModelType):
+        for line in stream:
+            if line.strip():
+                yield json_util.loads(line, json_options=options)
+
+
+def import_documents(model, stream, fmt='ndjson', validate=True,
+                     batch_size=1000, ordered=False):
     '''
-    A MongoDB storable document, without interface to persistant storage. It's
-    the base class for Models (with do have persistance) and also embedded
-    documents.
+    Stores the documents read from stream, as written by export_documents,
+    in the collection of model, with bulk writes of batch_size documents.
+    Documents with an _id replace the stored ones. With validate, they are
+    validated through the fields of model first, and left out if invalid.
+
+    Returns how many documents were written, and a list of (document,
+    error) pairs for the ones that were not. With ordered, nothing is
+    written after the first error.
     '''
 
-    def __init__(self, data=None, son=None):
-        self._data = {}
-        validate_exempt = []
+    _check_format(fmt)
 
-        for fname, field in list(self._fields.items()):
-            if son and fname in son:
-                # val is recovered for validation only.
-                val = field.to_python(son.get(fname))
+    collection = model._get_collection()
+    documents = _read_documents(stream, fmt)
+    written, errors = 0, []
 
-            elif data and fname in data:
-                val = data[fname]
+    while True:
+        batch, ops = [], []
+        read = 0
+
+        for son in islice(documents, batch_size):
+            read += 1
+
+            # A null _id is left for the server to make up, not stored.
+            if '_id' in son and son['_id'] is None:
+                del son['_id']
+
+            if validate:
+                try:
+                    model._from_son(dict(son)).validate()
+
+                except (ValidationError, DeserializationError) as exc:
+                    errors.append((son, exc))
+
+                    if ordered:
+                        break
+
+                    continue
+
+            batch.append(son)
+
+            if son.get('_id') is None:
+                ops.append(InsertOne(son))
 
             else:
-                val = field.default
-                val = val() if callable(val) else val
+                ops.append(ReplaceOne({'_id': son['_id']}, son, upsert=True))
 
-            # Field skips validation if value does not come from son AND no
-            # value is given for initialization.
-            if not son and not val:
-                validate_exempt.append(fname)
+        # A batch may have nothing to write, when all of it was invalid.
+        if not read:
+            break
 
-            val_storage = son.get(fname) if son else field.to_storage(val)
+        try:
+            if ops:
+                collection.bulk_write(ops, ordered=ordered)
+                written += len(ops)
 
-            self._data[fname] = val_storage
+        except BulkWriteError as exc:
+            failed = exc.details.get('writeErrors', [])
 
-        self.validate(exclude=validate_exempt)
+            for error in failed:
+                err = WriteError(error.get('errmsg'), error.get('code'), error)
+                errors.append((batch[error['index']], err))
 
-    def validate(self, exclude=None):
-        exclude = exclude if exclude else []
-        fields = [x for x in self._fields.items() if x[0] not in exclude]
+            written += exc.details.get('nInserted', 0) + \
+                exc.details.get('nUpserted', 0) + \
+                exc.details.get('nMatched', 0)
 
-        for fieldname, fieldinstance in fields:
-            try:
-                python_val = fieldinstance.to_python(self._data[fieldname])
-                fieldinstance.validate(python_val)
+        if errors and ordered:
+            break
 
-            except AssertionError:
-                val = self._data[fieldname]
+    model._forget()
 
-                raise ValidationError(self.__class__.__name__, fieldname, val)
+    return written, errors
 
 
-class Model(Document, metaclass=ModelType):
-    '''Base class for all classes.'''
+def _model(path):
+    '''Imports the Model at path, like myapp.models.Post.'''
 
-    # The _id field is required, nevertheless its blank attribute is True.
-    # The _id is automatically generated by MongoDB, and doesn't need to be
-    # provided.
-    _id = Field(blank=True)
+    module, _, name = path.rpartition('.')
+    model = getattr(import_module(module), name, None) if module else None
 
-    @classmethod
-    def find(cls, *args, **kwargs):
-        return db[cls._collection].find(*args, **kwargs)
+    if not isinstance(model, type) or not issubclass(model, Model):
+        raise MangaException('%s is not a Model.' % path)
 
-    @classmethod
-    def find_one(cls, *args, **kwargs):
-        return db[cls._collection].find_one(*args, **kwargs)
+    return model
 
-    @classmethod
-    def remove(cls, *args, **kwargs):
-        return db[cls._collection].remove(*args, **kwargs)
 
+def _open(path, fmt, mode):
+    '''
+    Opens path for the format, or returns standard input or output for -,
+    which are not to be closed.
+    '''
 
-    def delete(self):
-        if self._id:
-            db[self._collection].remove({'_id': self._id})
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
 
-            self._id = None
+        return stream.buffer if fmt == 'bson' else stream
 
-        else:
-            raise Exception
+    return open(path, mode + ('b' if fmt == 'bson' else ''))
 
-    def save(self):
-        for fieldname, fieldinstance in list(self._fields.items()):
-            value = fieldinstance.pre_save_val()
 
-            if value:
-                setattr(self, fieldname, value)
+def main(argv=None):
+    '''
+    Command line interface, for exporting and importing the collections of
+    models and creating their indexes. Run with --help for usage.
+    '''
 
-        self.validate()
+    parser = argparse.ArgumentParser(prog='manga.py')
+    parser.add_argument('--uri', help='MongoDB connection string')
+    parser.add_argument('--database', help='database name, if not in uri')
+    commands = parser.add_subparsers(dest='command', required=True)
 
-        if self._id:
-            spec = {'_id': self._id}
+    export = commands.add_parser('export', help='write documents to a file')
+    export.add_argument('--query', type=json_util.loads, default=None,
+                        help='extended JSON query for the documents')
+
+    load = commands.add_parser('import', help='store documents from a file')
+    load.add_argument('--no-validate', dest='validate', default=True,
+                      action='store_false', help="don't validate documents")
+    load.add_argument('--ordered', action='store_true',
+                      help='stop at the first error')
+
+    for command in (export, load):
+        command.add_argument('model', help='model path, like app.models.Post')
+        command.add_argument('file', help='file path, or - for stdin/stdout')
+        command.add_argument('--format', choices=('ndjson', 'bson'),
+                             help='defaults to bson for .bson files')
+        command.add_argument('--batch-size', type=int, default=1000)
+
+    indexes = commands.add_parser('indexes', help='create declared indexes')
+    indexes.add_argument('models', nargs='+', help='model paths')
+    indexes.add_argument('--drop', action='store_true',
+                         help='recreate changed and drop undeclared indexes')
+
+    args = parser.parse_args(argv)
 
-            db[self._collection].update(spec, self._data, upsert=True)
+    if args.command == 'indexes':
+        models = [_model(x) for x in args.models]
+
+        for alias in set(x._database for x in models):
+            setup(args.database, args.uri, alias=alias)
+
+        for model in models:
+            report = model.ensure_indexes(args.drop)
+            print('%s: created %s, changed %s, extra %s' %
+                  (model.__name__, report.created, report.changed,
+                   report.extra))
+
+        return 0
+
+    model = _model(args.model)
+    fmt = args.format or ('bson' if args.file.endswith('.bson') else 'ndjson')
+    setup(args.database, args.uri, alias=model._database)
+
+    stream = _open(args.file, fmt, 'w' if args.command == 'export' else 'r')
+
+    try:
+        if args.command == 'export':
+            count = export_documents(model, stream, fmt, args.query,
+                                     args.batch_size)
 
         else:
-            del self._data['_id']
+            written, errors = import_documents(model, stream, fmt,
+                                               args.validate,
+                                               args.batch_size, args.ordered)
 
-            self._data['_id'] = db[self._collection].insert(self._data)
+    finally:
+        if args.file != '-':
+            stream.close()
 
+    if args.command == 'export':
+        sys.stderr.write('Exported %s documents.\n' % count)
 
-class TimeStampedModel(Model):
-    created = DateTimeField(auto='created')
-    modified = DateTimeField(auto='modified')
+        return 0
+
+    sys.stderr.write('Imported %s documents.\n' % written)
+
+    for son, error in errors:
+        sys.stderr.write('%s: %s\n' % (son.get('_id'), error))
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    # Models import manga, so this has to run as manga, not as __main__.
+    import manga
+
+    sys.exit(manga.main())
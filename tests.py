@@ -1,32 +1,53 @@
 # -*- coding: utf-8 -*-
 
 # Python.
+import io
+import copy
+import time
+import pickle
+import asyncio
+from threading import Timer
 from datetime import datetime, timedelta
 
 # Python Libs.
 import unittest
 
 # Pymongo.
+from bson.int64 import Int64
 from bson.objectid import ObjectId
+from pymongo import IndexModel, ReadPreference, TEXT
 
 import manga
 from manga import (Document, Model, TimeStampedModel, ValidationError,
-                   DeserializationError, Field, ObjectIdField, StringField,
+                   DeserializationError, NotLoadedError, MangaException,
+                   IdentityMap, Cache, Field, ObjectIdField, StringField,
                    EmailField, DateTimeField, DictField, DocumentField,
-                   ListField, UTC)
+                   ListField, ReferenceField, UTC)
 
 
 db = manga.setup('_testsuite')
 
+
+# Pickled classes have to be found by name, so they can't be local.
+class TestPickled(Model):
+    name = StringField()
+    tags = ListField(field=StringField(), blank=True)
+
+
+class TestPickledCompact(Model):
+    _compact = True
+
+    name = StringField()
+
 class DBTest(unittest.TestCase):
     def setUp(self):
         assert db.name == '_testsuite'
 
-        for col in db.collection_names():
+        for col in db.list_collection_names():
             db[col].drop() if col != 'system.indexes' else None
 
     def tearDown(self):
-        for col in db.collection_names():
+        for col in db.list_collection_names():
             db[col].drop() if col != 'system.indexes' else None
 
     def test_field_structure(self):
@@ -60,8 +81,8 @@ class DBTest(unittest.TestCase):
                 '_id': None}
         self.assertEqual(data, m._data)
 
-    def test_manipulator(self):
-        """Test if the manipulator is working properly."""
+    def test_decoding(self):
+        """Test if documents are returned as instances of their model."""
 
         class T_NAME12x(Model):
             field1 = Field(blank=True)
@@ -80,7 +101,7 @@ class DBTest(unittest.TestCase):
             class UniqueModel(Model):
                 field1 = Field(blank=False)
 
-        err = 'Manipulator for collection uniquemodel was already defined.'
+        err = 'Model for collection uniquemodel was already defined.'
         self.assertEqual(err, str(exc.exception))
 
     def test_field_validation(self):
@@ -429,10 +450,1154 @@ class DBTest(unittest.TestCase):
         class TestListField2(Model):
             l3 = ListField()
 
-        db.testlistfield2.insert({'l3': 'not a list'})
+        db.testlistfield2.insert_one({'l3': 'not a list'})
+
+        x = TestListField2.find_one()
+
+        with self.assertRaises(DeserializationError):
+            x.l3
+
+        class TestListField3(Model):
+            _validate_on_load = True
+
+            l3 = ListField()
+
+        db.testlistfield3.insert_one({'l3': 'not a list'})
 
         with self.assertRaises(DeserializationError):
-            TestListField2.find_one()
+            TestListField3.find_one()
+
+    def test_lazy_load(self):
+        class TestLazyDoc(Document):
+            field1 = StringField()
+
+        class TestLazy(Model):
+            name = StringField(length=(2, 10))
+            doc = DocumentField(document=TestLazyDoc)
+
+        db.testlazy.insert_one({'name': 'x', 'doc': {'field1': 'asdf'}})
+
+        x = TestLazy.find_one()
+        self.assertEqual(x.name, 'x')
+        self.assertEqual(x.doc.field1, 'asdf')
+
+        x.doc.field1 = 'qwer'
+        self.assertEqual(x._data['doc'], {'field1': 'qwer'})
+
+        with self.assertRaises(ValidationError):
+            x.save()
+
+        x.name = 'xyz'
+        x.save()
+
+        self.assertEqual(TestLazy.find_one().doc.field1, 'qwer')
+
+    def test_partial_save(self):
+        class TestRect(Document):
+            v1 = Field()
+            v2 = Field()
+
+        class TestPartial(Model):
+            name = StringField()
+            tags = ListField(blank=True)
+            rect = DocumentField(document=TestRect)
+
+        x = TestPartial({'name': 'first',
+                         'rect': TestRect({'v1': 1, 'v2': 2})})
+        x.save()
+
+        db.testpartial.update_one({'_id': x._id}, {'$set': {'other': 'kept'}})
+
+        x = TestPartial.find_one()
+        self.assertEqual(x._changes(), {})
+
+        x.name = 'second'
+        x.tags.append('new')
+        x.rect = TestRect({'v1': 1, 'v2': 3})
+
+        expected = {'$set': {'name': 'second', 'tags': ['new'], 'rect.v2': 3}}
+        self.assertEqual(x._changes(), expected)
+
+        x.save()
+        self.assertEqual(x._changes(), {})
+
+        raw = db.testpartial.find_one()
+        self.assertEqual(raw['other'], 'kept')
+        self.assertEqual(raw['name'], 'second')
+        self.assertEqual(raw['tags'], ['new'])
+        self.assertEqual(raw['rect'], {'v1': 1, 'v2': 3})
+
+        # Values changed straight in _data are saved too.
+        x._data['notes'] = 'raw'
+        del x._data['other']
+        x.save()
+
+        raw = db.testpartial.find_one()
+        self.assertEqual(raw['notes'], 'raw')
+        self.assertNotIn('other', raw)
+
+        y = TestPartial.find_one()
+        y._data['name'] = 'fourth'
+        y.save()
+        self.assertEqual(db.testpartial.find_one()['name'], 'fourth')
+
+        db.testpartial.update_one({'_id': x._id}, {'$set': {'name': 'third'}})
+        x.save(full=True)
+
+        raw = db.testpartial.find_one()
+        self.assertEqual(raw['name'], 'second')
+
+    def test_save_many(self):
+        class TestBulk(TimeStampedModel):
+            name = StringField()
+
+        db.testbulk.create_index('name', unique=True)
+
+        docs = [TestBulk({'name': 'a'}), TestBulk(), TestBulk({'name': 'b'}),
+                TestBulk({'name': 'a'})]
+
+        result = TestBulk.save_many(docs, batch_size=2)
+
+        self.assertEqual(result.saved, [docs[0], docs[2]])
+        self.assertEqual([x[0] for x in result.errors], [docs[1], docs[3]])
+        self.assertIsInstance(result.errors[0][1], ValidationError)
+
+        self.assertIsInstance(docs[0]._id, ObjectId)
+        self.assertIsNone(docs[1]._id)
+        self.assertIsNone(docs[3]._id)
+        self.assertEqual(db.testbulk.count_documents({}), 2)
+
+        # Ordered runs stop at the first failure, after writing what was
+        # queued before it.
+        ordered = [TestBulk({'name': 'e'}), TestBulk(),
+                   TestBulk({'name': 'f'})]
+        result = TestBulk.save_many(ordered, ordered=True)
+
+        self.assertEqual(result.saved, ordered[:1])
+        self.assertEqual([x[0] for x in result.errors], ordered[1:2])
+        self.assertIsNone(ordered[2]._id)
+        self.assertEqual(db.testbulk.count_documents({}), 3)
+
+        docs[0].name = 'c'
+        result = TestBulk.save_many(docs[:1])
+
+        self.assertEqual(result.errors, [])
+        self.assertEqual(TestBulk.find_one({'_id': docs[0]._id}).name, 'c')
+
+        # Documents that can't be saved don't stop the others.
+        partial = next(TestBulk.find().only('name'))
+        partial._id = ObjectId()
+        result = TestBulk.save_many([partial, TestBulk({'name': 'd'})])
+
+        self.assertEqual(len(result.saved), 1)
+        self.assertIs(result.errors[0][0], partial)
+        self.assertIsInstance(result.errors[0][1], MangaException)
+
+        # Neither do errors other than ValidationError, raised by clean or
+        # by stored values that can't be read.
+        class TestBulkClean(Model):
+            name = StringField()
+            tags = ListField(field=StringField(), blank=True)
+
+            def clean(self):
+                if self.name == 'z':
+                    raise ValueError(self.name)
+
+        docs = [TestBulkClean({'name': 'y'}), TestBulkClean({'name': 'z'}),
+                TestBulkClean({'name': 'x'})]
+        docs[2]._data['tags'] = 'not a list'
+        result = TestBulkClean.save_many(docs)
+
+        self.assertEqual(result.saved, docs[:1])
+        self.assertEqual([type(x[1]) for x in result.errors],
+                         [ValueError, DeserializationError])
+        self.assertEqual(db.testbulkclean.count_documents({}), 1)
+
+    def test_converted_cache(self):
+        class TestCacheDoc(Document):
+            field1 = StringField()
+
+        class TestCache(Model):
+            rect = DocumentField(document=TestCacheDoc)
+            items = ListField(field=DocumentField(document=TestCacheDoc))
+
+        x = TestCache({'rect': TestCacheDoc({'field1': 'a'}),
+                       'items': [TestCacheDoc({'field1': 'b'})]})
+        x.save()
+
+        x = TestCache.find_one()
+        self.assertIs(x.rect, x.rect)
+        self.assertIs(x.items, x.items)
+
+        x.rect.field1 = 'c'
+        x.items.append(TestCacheDoc({'field1': 'd'}))
+        x.save()
+
+        x = TestCache.find_one()
+        self.assertEqual(x.rect.field1, 'c')
+        self.assertEqual([y.field1 for y in x.items], ['b', 'd'])
+
+        x.rect = TestCacheDoc({'field1': 'e'})
+        self.assertEqual(x.rect.field1, 'e')
+
+        x.items.append('not a document')
+
+        with self.assertRaises(ValidationError):
+            x.save()
+
+    def test_queryset(self):
+        class TestQuery(Model):
+            name = StringField()
+            body = StringField()
+
+        for x in range(5):
+            TestQuery({'name': 'n%s' % x, 'body': 'long text'}).save()
+
+        self.assertEqual(TestQuery.find().count(), 5)
+        self.assertEqual(TestQuery.find().skip(1).limit(3).count(), 3)
+
+        qs = TestQuery.find({'name': {'$ne': 'n0'}}).sort('name', -1)
+        self.assertEqual([x.name for x in qs.batch_size(2)],
+                         ['n4', 'n3', 'n2', 'n1'])
+
+        x = next(TestQuery.find().only('name').sort('name').skip(1))
+        self.assertEqual(x.name, 'n1')
+        self.assertEqual(sorted(x._data.keys()), ['_id', 'name'])
+
+        with self.assertRaises(NotLoadedError):
+            x.body
+
+        with self.assertRaises(MangaException):
+            x.save(full=True)
+
+        x.name = 'n10'
+        x.save()
+
+        y = TestQuery.find_one(x._id)
+        self.assertEqual((y.name, y.body), ('n10', 'long text'))
+
+        y = next(TestQuery.find().exclude('body'))
+        self.assertIsNotNone(y.name)
+
+        with self.assertRaises(NotLoadedError):
+            y.body
+
+    def test_raw_values(self):
+        class TestValues(Model):
+            name = StringField()
+            rect = DictField()
+
+        TestValues({'name': 'a', 'rect': {'v1': 1}}).save()
+
+        raw = next(TestValues.find().as_raw())
+        self.assertEqual(type(raw), dict)
+        self.assertEqual(raw['rect'], {'v1': 1})
+
+        self.assertEqual(list(TestValues.find().values('name', 'rect.v1')),
+                         [{'name': 'a', 'rect.v1': 1}])
+        self.assertEqual(list(TestValues.find().values_list('name', 'rect')),
+                         [('a', {'v1': 1})])
+        names = TestValues.find().values_list('name', flat=True)
+        self.assertEqual(list(names), ['a'])
+
+        with self.assertRaises(MangaException):
+            TestValues.find().values_list('name', 'rect', flat=True)
+
+    def test_connections(self):
+        other = manga.setup('_testsuite_other', 'mongodb://localhost:27017',
+                            alias='other', maxPoolSize=5)
+
+        class TestOtherDb(Model):
+            _database = 'other'
+
+            name = StringField()
+
+        class TestNoDb(Model):
+            _database = 'missing'
+
+        TestOtherDb({'name': 'a'}).save(write_concern={'w': 1})
+
+        self.assertEqual(other.testotherdb.count_documents({}), 1)
+        self.assertEqual(db.testotherdb.count_documents({}), 0)
+
+        pref = ReadPreference.SECONDARY_PREFERRED
+        self.assertEqual(TestOtherDb.find().read_preference(pref).count(), 1)
+        self.assertEqual(TestOtherDb.find_one(read_preference=pref).name, 'a')
+
+        with self.assertRaises(MangaException):
+            TestNoDb.find_one()
+
+        other.client.drop_database('_testsuite_other')
+
+    def test_asyncio(self):
+        if manga.AsyncMongoClient is None:
+            self.skipTest('pymongo has no asyncio support')
+
+        class TestAsync(Model):
+            name = StringField()
+
+        async def run():
+            x = TestAsync({'name': 'a'})
+            await x.asave()
+
+            y = await TestAsync.afind_one(x._id)
+            self.assertEqual(y.name, 'a')
+
+            y.name = 'b'
+            await y.asave()
+
+            TestAsync({'name': 'c'}).save()
+
+            names = [z.name async for z in TestAsync.afind().sort('name')]
+            self.assertEqual(names, ['b', 'c'])
+
+            qs = TestAsync.afind()
+            await qs.__anext__()
+            self.assertRaises(MangaException, qs.close)
+            await qs.aclose()
+            self.assertEqual(await TestAsync.afind().acount(), 2)
+
+            await y.adelete()
+            self.assertIsNone(await TestAsync.afind_one({'name': 'b'}))
+
+            await TestAsync.aremove()
+            self.assertEqual(TestAsync.find().count(), 0)
+
+        asyncio.run(run())
+
+    def test_indexes(self):
+        class TestIndexes(Model):
+            _indexes = [[('name', 1), ('age', -1)],
+                        {'keys': 'created', 'expireAfterSeconds': 3600},
+                        {'keys': ['age'], 'name': 'adults',
+                         'partialFilterExpression': {'age': {'$gte': 18}}}]
+
+            name = StringField(index=True)
+            email = EmailField(unique=True)
+            age = Field(blank=True)
+            created = DateTimeField(auto='created')
+
+        db.testindexes.create_index('other')
+
+        report = TestIndexes.ensure_indexes()
+
+        expected = ['email_1', 'name_1', 'name_1_age_-1', 'created_1',
+                    'adults']
+        self.assertEqual(report.created, expected)
+        self.assertEqual(report.extra, ['other_1'])
+
+        info = db.testindexes.index_information()
+        self.assertTrue(info['email_1']['unique'])
+        self.assertEqual(info['created_1']['expireAfterSeconds'], 3600)
+
+        report = TestIndexes.ensure_indexes(drop=True)
+
+        self.assertEqual((report.created, report.changed), ([], []))
+        self.assertNotIn('other_1', db.testindexes.index_information())
+
+    def test_text_indexes(self):
+        class TestText(Model):
+            _indexes = [[('kind', 1), ('title', TEXT), ('body', TEXT)]]
+
+            kind = StringField()
+            title = StringField()
+            body = StringField(blank=True)
+
+        report = TestText.ensure_indexes()
+        self.assertEqual(len(report.created), 1)
+
+        report = TestText.ensure_indexes(drop=True)
+        self.assertEqual((report.created, report.changed), ([], []))
+
+        # Text indexes as the server reports them.
+        document = TestText._index_models[0].document
+        info = {'key': [('kind', 1), ('_fts', 'text'), ('_ftsx', 1)],
+                'weights': {'body': 1, 'title': 1},
+                'default_language': 'english',
+                'language_override': 'language', 'textIndexVersion': 3}
+
+        self.assertTrue(manga._same_index(info, document))
+
+        weighted = IndexModel(document['key'].items(),
+                              weights={'title': 5}).document
+        self.assertFalse(manga._same_index(info, weighted))
+
+        info['weights'] = {'body': 1, 'title': 5}
+        self.assertTrue(manga._same_index(info, weighted))
+
+    def test_compiled_validators(self):
+        class TestCompiled(Model):
+            s = StringField(length=(2, 4))
+            f = Field()
+
+        class TestCustom(TestCompiled):
+            def validate(self, exclude=None):
+                super(TestCustom, self).validate(exclude)
+
+                assert self.s != 'bad'
+
+        class TestCustomChild(TestCustom):
+            g = Field(blank=True)
+
+        self.assertTrue(TestCompiled.validate._compiled)
+        self.assertTrue(TestCompiled.__init__._compiled)
+        self.assertIs(TestCustomChild.validate, TestCustom.validate)
+
+        x = TestCompiled({'s': 'ab', 'f': 1})
+        x._data['s'] = 'abcde'
+
+        with self.assertRaises(ValidationError) as exc:
+            x.validate()
+
+        expected_str = 'TestCompiled: trying to set s <- abcde'
+        self.assertEqual(expected_str, str(exc.exception))
+        x.validate(exclude=['s'])
+
+        with self.assertRaises(ValidationError):
+            TestCompiled(son={'s': 'ab'})
+
+        with self.assertRaises(AssertionError):
+            TestCustomChild({'s': 'bad', 'f': 1})
+
+    def test_compact(self):
+        class TestCompactRect(Document):
+            _compact = True
+
+            v1 = Field()
+            v2 = Field(blank=True)
+
+        class TestCompact(Model):
+            _compact = True
+
+            name = StringField()
+            rect = DocumentField(document=TestCompactRect)
+            rects = ListField(field=DocumentField(document=TestCompactRect),
+                              blank=True)
+
+        x = TestCompact({'name': 'a', 'rect': TestCompactRect({'v1': 1}),
+                         'rects': [TestCompactRect({'v1': 2, 'v2': 3})]})
+
+        self.assertFalse(hasattr(x, '__dict__'))
+        self.assertFalse(hasattr(x.rect, '__dict__'))
+
+        x.save()
+
+        y = TestCompact.find_one()
+        self.assertEqual(y._data, {'_id': x._id, 'name': 'a',
+                                   'rect': {'v1': 1, 'v2': None},
+                                   'rects': [{'v1': 2, 'v2': 3}]})
+
+        y.name = 'b'
+        y.rect.v1 = 5
+        y.rects[0].v2 = 4
+        y.save()
+
+        z = TestCompact.find_one()
+        self.assertEqual((z.name, z.rect.v1, z.rects[0].v2), ('b', 5, 4))
+
+        z.delete()
+        self.assertEqual(TestCompact.find_one(), None)
+
+    def test_pickle_and_copy(self):
+        plain = TestPickled({'name': 'a', 'tags': ['x']})
+        TestPickled({'name': 'b'}).save()
+        TestPickledCompact({'name': 'c'}).save()
+        loaded = TestPickled.find_one({'name': 'b'})
+        compact = TestPickledCompact.find_one()
+        compact.name = 'd'
+
+        for x in (plain, loaded, compact):
+            for y in (pickle.loads(pickle.dumps(x)), copy.deepcopy(x)):
+                self.assertIsNot(y, x)
+                self.assertEqual(dict(y._data), dict(x._data))
+                self.assertEqual(y._persisted, x._persisted)
+
+        y = copy.deepcopy(compact)
+        self.assertFalse(hasattr(y, '__dict__'))
+        y.save()
+        self.assertEqual(TestPickledCompact.find_one().name, 'd')
+
+        y = pickle.loads(pickle.dumps(loaded))
+        y.tags.append('z')
+        y.save()
+        self.assertEqual(TestPickled.find_one({'name': 'b'}).tags, ['z'])
+
+    def test_identity_map(self):
+        class TestIdentity(Model):
+            name = StringField()
+
+        x = TestIdentity({'name': 'a'})
+        x.save()
+
+        with IdentityMap() as imap:
+            y = TestIdentity.find_one(x._id)
+            self.assertIsNot(x, y)
+            self.assertIs(TestIdentity.find_one({'_id': x._id}), y)
+            self.assertIs(list(TestIdentity.find())[0], y)
+            self.assertIsNot(TestIdentity.find_one({'name': 'a'}), None)
+            self.assertEqual((imap.hits, imap.misses), (1, 1))
+
+            z = TestIdentity({'name': 'b'})
+            z.save()
+            self.assertIs(TestIdentity.find_one(z._id), z)
+
+            TestIdentity.remove({'name': 'b'})
+            self.assertEqual(TestIdentity.find_one(z._id), None)
+
+            # Documents returned as they were before an update are stale.
+            old = TestIdentity.find_one_and_update(x._id, new=False,
+                                                   set={'name': 'c'})
+            self.assertEqual(old.name, 'a')
+            self.assertEqual(TestIdentity.find_one(x._id).name, 'c')
+
+        self.assertIsNot(TestIdentity.find_one(x._id), y)
+
+    def test_cache(self):
+        cache = Cache(size=2)
+
+        class TestCached(Model):
+            _cache = cache
+
+            name = StringField()
+
+        x = TestCached({'name': 'a'})
+        x.save()
+
+        self.assertEqual(TestCached.find_one(x._id).name, 'a')
+        db.testcached.update_one({'_id': x._id}, {'$set': {'name': 'b'}})
+
+        y = TestCached.find_one(x._id)
+        self.assertEqual(y.name, 'a')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        y.name = 'c'
+        self.assertEqual(TestCached.find_one(x._id).name, 'a')
+
+        y.save()
+        self.assertEqual(TestCached.find_one(x._id).name, 'c')
+
+        y.delete()
+        self.assertEqual(TestCached.find_one(x._id), None)
+
+        ids = [TestCached({'name': str(i)}) for i in range(3)]
+        TestCached.save_many(ids)
+        ids = [x._id for x in ids]
+
+        for _id in ids:
+            TestCached.find_one(_id)
+
+        self.assertEqual(len(cache._entries), 2)
+
+        TestCached.remove()
+        self.assertEqual(len(cache._entries), 0)
+
+        cache.ttl = 0
+        hits = cache.hits
+        z = TestCached({'name': 'd'})
+        z.save()
+
+        TestCached.find_one(z._id)
+        TestCached.find_one(z._id)
+        self.assertEqual(cache.hits, hits)
+
+    def test_references(self):
+        class TestAuthor(Model):
+            name = StringField()
+
+        class TestPost(Model):
+            title = StringField()
+            author = ReferenceField(TestAuthor)
+            tags = ListField(field=ReferenceField('testtag'), blank=True)
+
+        class TestTag(Model):
+            name = StringField()
+
+        a, b = TestAuthor({'name': 'a'}), TestAuthor({'name': 'b'})
+        t = TestTag({'name': 't'})
+
+        for x in (a, b, t):
+            x.save()
+
+        with self.assertRaises(ValidationError):
+            TestPost({'title': 'x', 'author': TestAuthor({'name': 'c'})})
+
+        with self.assertRaises(ValidationError):
+            TestPost({'title': 'x', 'author': a}).author = t
+
+        for i, author in enumerate([a, b, a]):
+            TestPost({'title': str(i), 'author': author, 'tags': [t]}).save()
+
+        self.assertEqual(db.testpost.find_one()['author'], a._id)
+
+        post = TestPost.find_one({'title': '1'})
+        self.assertEqual(post.author.name, 'b')
+        self.assertEqual(post.tags[0].name, 't')
+
+        post.author = a
+        post.save()
+        self.assertEqual(TestPost.find_one(post._id).author._id, a._id)
+
+        posts = TestPost.find().sort('title').prefetch('author', 'tags')
+
+        # Whatever is read later doesn't make it into the posts.
+        first = next(posts)
+        db.testauthor.drop()
+        db.testtag.drop()
+
+        self.assertEqual([x.author.name for x in posts], ['a', 'a'])
+        self.assertEqual((first.author.name, first.tags[0].name), ('a', 't'))
+
+        with self.assertRaises(MangaException):
+            TestPost.find().prefetch('title')
+
+        # References to documents that are gone read as None, and are kept.
+        post = TestPost.find_one(post._id)
+        self.assertEqual((post.author, post.tags), (None, [None]))
+        self.assertIsNot(post.tags[0], None)
+        self.assertEqual(repr(post.tags[0]), '<Missing %r>' % t._id)
+
+        other = TestTag({'name': 'u'})
+        other.save()
+        post.tags.append(other)
+        post.title = 'changed'
+        post.save()
+
+        stored = db.testpost.find_one(post._id)
+        self.assertEqual((stored['author'], stored['tags']),
+                         (a._id, [t._id, other._id]))
+
+        # Each missing reference keeps its own _id when the list changes.
+        tags = [TestTag({'name': x}) for x in 'abc']
+
+        for x in tags:
+            x.save()
+
+        post = TestPost({'title': 'tags', 'author': a, 'tags': tags})
+        post.save()
+        db.testtag.delete_many({'name': {'$in': ['a', 'c']}})
+
+        post = TestPost.find_one(post._id)
+        self.assertEqual([x and x.name for x in post.tags], [None, 'b', None])
+        self.assertEqual(post.tags[0], None)
+
+        post.tags.remove(None)
+        post.tags.reverse()
+        post.save()
+
+        self.assertEqual(db.testpost.find_one(post._id)['tags'],
+                         [tags[2]._id, tags[1]._id])
+
+    def test_atomic_updates(self):
+        class TestCounter(Model):
+            name = StringField()
+            views = Field(blank=True)
+            tags = ListField(field=StringField(), blank=True)
+
+        x = TestCounter({'name': 'a', 'views': 0})
+        x.save()
+
+        TestCounter.update(x._id, inc={'views': 2}, push={'tags': 'a'})
+        self.assertEqual(TestCounter.find_one(x._id).views, 2)
+
+        with self.assertRaises(ValidationError):
+            TestCounter.update(x._id, push={'tags': 1})
+
+        with self.assertRaises(ValidationError):
+            TestCounter.update(x._id, unset=['name'])
+
+        self.assertEqual(TestCounter._update_document({'unset': ['tags']}),
+                         {'$unset': {'tags': ''}})
+
+        with self.assertRaises(MangaException):
+            TestCounter.update(x._id, inc={'nothing': 1})
+
+        with self.assertRaises(MangaException):
+            TestCounter.update(x._id, push={'name': 'b'})
+
+        # The instance gets what is stored, including others' changes.
+        x.inc('views')
+        self.assertEqual(x.views, 3)
+
+        x.push('tags', 'b')
+        x.add_to_set('tags', 'a')
+        self.assertEqual(x.tags, ['a', 'b'])
+
+        # Unsaved changes are kept, and saved without undoing the update.
+        x.tags.append('c')
+        x.pull('tags', 'a')
+        self.assertEqual(x.tags, ['b', 'c'])
+        self.assertEqual(db.testcounter.find_one()['tags'], ['b'])
+
+        x.save()
+        self.assertEqual(db.testcounter.find_one()['tags'], ['b', 'c'])
+
+        y = TestCounter.find_one_and_update({'name': 'a'}, set={'name': 'b'},
+                                            inc={'views': 1})
+        self.assertEqual((y.name, y.views), ('b', 4))
+
+        with self.assertRaises(MangaException):
+            TestCounter({'name': 'c'}).inc('views')
+
+        with self.assertRaises(MangaException):
+            x.inc('views.total')
+
+    def test_export_import(self):
+        class TestDump(Model):
+            name = StringField()
+            when = DateTimeField(blank=True)
+
+        when = datetime(2013, 1, 1, tzinfo=UTC())
+
+        for i in range(5):
+            TestDump({'name': 'n%s' % i, 'when': when}).save()
+
+        db.testdump.update_one({}, {'$set': {'other': Int64(1)}})
+
+        for fmt, stream in (('ndjson', io.StringIO()), ('bson', io.BytesIO())):
+            count = manga.export_documents(TestDump, stream, fmt,
+                                           batch_size=2)
+            self.assertEqual(count, 5)
+
+            before = list(db.testdump.find().sort('_id'))
+            db.testdump.drop()
+            stream.seek(0)
+
+            written, errors = manga.import_documents(TestDump, stream, fmt,
+                                                     batch_size=2)
+            self.assertEqual((written, errors), (5, []))
+            self.assertEqual(list(db.testdump.find().sort('_id')), before)
+            stored = db.testdump.find_one({'other': {'$exists': True}})
+            self.assertEqual(type(stored['other']), Int64)
+
+        stream = io.StringIO('{"name": ""}\n{"name": "ok"}\n')
+        written, errors = manga.import_documents(TestDump, stream)
+
+        self.assertEqual(written, 1)
+        self.assertEqual(errors[0][0], {'name': ''})
+        self.assertEqual(type(errors[0][1]), ValidationError)
+
+        # A batch with nothing valid in it doesn't end the import.
+        stream = io.StringIO('{"name": ""}\n{"name": "ok"}\n{"name": "ok2"}\n')
+        written, errors = manga.import_documents(TestDump, stream,
+                                                 batch_size=1)
+
+        self.assertEqual((written, len(errors)), (2, 1))
+
+        # Null _ids are made up, and values that can't be read are errors.
+        class TestTagged(Model):
+            name = StringField()
+            tags = ListField(field=StringField(), blank=True)
+
+        stream = io.StringIO('{"_id": null, "name": "a", "tags": []}\n'
+                             '{"name": "b", "tags": "x"}\n'
+                             '{"name": "c", "tags": ["x"]}\n')
+        written, errors = manga.import_documents(TestTagged, stream)
+
+        self.assertEqual(written, 2)
+        self.assertEqual(type(errors[0][1]), DeserializationError)
+        self.assertIsNotNone(db.testtagged.find_one({'name': 'a'})['_id'])
+
+    def test_aggregate(self):
+        class TestSale(Model):
+            item = StringField()
+            amount = Field()
+            when = DateTimeField(blank=True)
+            tags = ListField(field=StringField(), blank=True)
+
+        when = datetime(2013, 1, 1, tzinfo=UTC())
+
+        for item, amount in (('a', 1), ('b', 2), ('a', 3)):
+            TestSale({'item': item, 'amount': amount, 'when': when,
+                      'tags': ['x', 'y']}).save()
+
+        rows = TestSale.aggregate().match(amount={'$gt': 1}) \
+            .group('item', total={'$sum': '$amount'}, last={'$max': '$when'}) \
+            .sort('_id').allow_disk_use().batch_size(10)
+
+        self.assertEqual(list(rows), [{'_id': 'a', 'total': 3, 'last': when},
+                                      {'_id': 'b', 'total': 2, 'last': when}])
+
+        with self.assertRaises(MangaException):
+            TestSale.aggregate().match(nothing=1)
+
+        with self.assertRaises(MangaException):
+            TestSale.aggregate().group('item').sort('amount')
+
+        rows = TestSale.aggregate().project('item', 'tags').unwind('tags') \
+            .match(item='b')
+
+        self.assertEqual([x['tags'] for x in rows], ['x', 'y'])
+
+        class TestSaleNote(Model):
+            sale = ReferenceField(TestSale)
+            text = StringField()
+
+        sale = TestSale.find_one({'item': 'b'})
+        TestSaleNote({'sale': sale, 'text': 'hi'}).save()
+
+        row = list(TestSaleNote.aggregate().lookup('sale').unwind('sale')
+                   .typed())[0]
+        self.assertEqual((row['text'], row['sale'].amount), ('hi', 2))
+
+        async def typed():
+            rows = TestSale.aggregate().match(item='b').project('when').typed()
+
+            return [x async for x in rows]
+
+        self.assertEqual(asyncio.run(typed())[0]['when'], when)
+
+    def test_listeners(self):
+        class TestListened(Model):
+            name = StringField()
+
+        class Recorder(manga.Listener):
+            def __init__(self):
+                self.names, self.operations = [], []
+
+            def started(self, operation):
+                self.names.append(operation.name)
+
+            def finished(self, operation):
+                self.operations.append(operation)
+
+        recorder, stats = Recorder(), manga.LatencyStats()
+        manga.add_listener(recorder)
+        manga.add_listener(stats)
+
+        try:
+            x = TestListened({'name': 'a'})
+            x.save()
+            TestListened.save_many([TestListened({'name': 'b'})])
+            list(TestListened.find({'name': {'$in': ['a', 'b']}}))
+            TestListened.find_one(x._id)
+            TestListened.remove({'name': 'b'})
+
+            with self.assertRaises(MangaException):
+                TestListened.update(x._id, inc={'nothing': 1})
+
+        finally:
+            manga.remove_listener(recorder)
+            manga.remove_listener(stats)
+
+        names = ['save', 'save_many', 'find', 'find_one', 'remove', 'update']
+        self.assertEqual(recorder.names, names)
+        self.assertEqual([x.name for x in recorder.operations], names)
+
+        save, save_many, find, find_one, remove, update = recorder.operations
+        self.assertEqual((save.collection, save.count), ('testlistened', 1))
+        self.assertTrue(save.validate_time > 0)
+        self.assertTrue(save.duration >= save.validate_time)
+        self.assertEqual(save_many.count, 1)
+        self.assertEqual((find.shape, find.count), ({'name': {'$in': '?'}}, 2))
+        self.assertTrue(find.decode_time > 0)
+        self.assertEqual((find_one.shape, find_one.count), ({'_id': '?'}, 1))
+        self.assertEqual(remove.count, 1)
+        self.assertEqual(type(update.error), MangaException)
+
+        summary = stats.summary()
+        self.assertEqual(summary[('testlistened', 'find')]['count'], 1)
+        self.assertEqual(stats.percentile('testlistened', 'save', 99),
+                         save.duration)
+
+        # Finds left before their results run out finish all the same.
+        recorder = Recorder()
+        manga.add_listener(recorder)
+
+        try:
+            for x in TestListened.find():
+                break
+
+            next(TestListened.find())
+            qs = TestListened.find()
+            next(qs)
+            qs.close()
+
+        finally:
+            manga.remove_listener(recorder)
+
+        self.assertEqual(recorder.names, ['find'] * 3)
+        self.assertEqual([x.count for x in recorder.operations], [1, 1, 1])
+
+        # Errors in listeners are logged, without changing what happens.
+        class Failing(manga.Listener):
+            def started(self, operation):
+                raise ValueError('started')
+
+            def finished(self, operation):
+                raise ValueError('finished')
+
+        failing = Failing()
+        manga.add_listener(failing)
+
+        try:
+            with self.assertLogs('manga', 'ERROR') as logs:
+                TestListened({'name': 'c'}).save()
+
+                with self.assertRaises(MangaException):
+                    TestListened.update(None, unknown={'name': 'd'})
+
+        finally:
+            manga.remove_listener(failing)
+
+        self.assertEqual(len(logs.records), 4)
+        self.assertEqual(TestListened.find({'name': 'c'}).count(), 1)
+
+    def test_explain_capture(self):
+        class TestExplained(Model):
+            name = StringField(index=True)
+            other = Field(blank=True)
+
+        TestExplained.ensure_indexes()
+        TestExplained({'name': 'a', 'other': 1}).save()
+
+        capture = manga.ExplainCapture(threshold=0)
+        manga.add_listener(capture)
+
+        try:
+            list(TestExplained.find({'name': 'a'}))
+            TestExplained.find_one({'other': 1})
+            TestExplained.find_one({'other': 2})
+
+        finally:
+            manga.remove_listener(capture)
+
+        self.assertEqual(len(capture.plans), 2)
+
+        issue, = capture.issues()
+        self.assertEqual((issue.keys, issue.count), (['other'], 2))
+        self.assertTrue(issue.collscan)
+        self.assertFalse(issue.indexed)
+        self.assertIn("testexplained {'other': '?'}: COLLSCAN",
+                      capture.report())
+
+    def test_pagination_and_parallel_scan(self):
+        class TestScanned(Model):
+            number = Field(blank=True)
+
+        TestScanned.save_many(TestScanned({'number': x}) for x in range(25))
+
+        page = list(TestScanned.find().paginate_after(page_size=10))
+        self.assertEqual([x.number for x in page], list(range(10)))
+        page = list(TestScanned.find().paginate_after(page[-1]._id, 10))
+        self.assertEqual(page[0].number, 10)
+        page = list(TestScanned.find().sort('_id', -1).paginate_after(
+            page[0]._id, 3))
+        self.assertEqual([x.number for x in page], [9, 8, 7])
+        self.assertEqual([len(x) for x in TestScanned.find().pages(10)],
+                         [10, 10, 5])
+        self.assertRaises(MangaException, TestScanned.find().sort(
+            'number').paginate_after)
+
+        ranges = TestScanned.split_ranges(3)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (None, None))
+
+        seen = []
+        count = TestScanned.parallel_scan(
+            lambda page: seen.extend(x.number for x in page), workers=2,
+            spec={'number': {'$lt': 20}}, batch_size=3)
+        self.assertEqual(count, 20)
+        self.assertEqual(sorted(seen), list(range(20)))
+
+    def test_watch_and_view(self):
+        class TestWatched(Model):
+            code = StringField()
+            name = StringField(blank=True)
+
+        TestWatched({'code': 'a', 'name': 'first'}).save()
+        changes = TestWatched.watch(wait=0.1)
+        self.assertEqual(next(changes), None)
+
+        obj = TestWatched({'code': 'b'})
+        obj.save()
+        change = next(changes)
+        self.assertEqual((change.operation, change._id), ('insert', obj._id))
+        self.assertEqual(change.document.code, 'b')
+        obj.delete()
+        change = next(changes)
+        self.assertEqual((change.operation, change.document), ('delete', None))
+        changes.close()
+
+        # Without wait, the next change is waited for. Resuming after the
+        # last change makes sure the save isn't missed while the stream
+        # opens.
+        obj = TestWatched({'code': 'e'})
+        Timer(0.1, obj.save).start()
+        changes = TestWatched.watch(resume_after=change.token)
+        self.assertEqual(next(changes).document.code, 'e')
+        changes.close()
+        obj.delete()
+
+        with manga.View(TestWatched, key='code', wait=0.1) as view:
+            self.assertEqual(view['a'].name, 'first')
+            TestWatched({'code': 'c'}).save()
+            TestWatched.update({'code': 'a'}, set={'name': 'changed'})
+            TestWatched.remove({'code': 'c'})
+            TestWatched({'code': 'd'}).save()
+
+            for x in range(50):
+                if 'd' in view:
+                    break
+
+                time.sleep(0.02)
+
+        self.assertEqual(sorted(view), ['a', 'd'])
+        self.assertEqual(view['a'].name, 'changed')
+        self.assertEqual(view.error, None)
+
+    def test_raw_saving(self):
+        class TestRawSaved(Model):
+            name = StringField()
+            created = DateTimeField(auto='created')
+            modified = DateTimeField(auto='modified')
+
+        self.assertEqual([x for x, _ in TestRawSaved._pre_save_fields],
+                         ['modified'])
+        self.assertEqual(sorted(TestRawSaved._storage),
+                         ['created', 'modified', 'name'])
+
+        class StampField(DateTimeField):
+            def pre_save_val(self):
+                return datetime(2013, 1, 1, tzinfo=UTC())
+
+        class TestStamped(Model):
+            stamp = StampField(blank=True)
+
+        self.assertEqual([x for x, _ in TestStamped._pre_save_fields],
+                         ['stamp'])
+
+        obj = TestRawSaved({'name': ' first '})
+        raw = obj.to_bson()
+        self.assertEqual(list(raw), ['_id', 'name', 'created', 'modified'])
+        self.assertEqual(raw['name'], 'first')
+
+        obj.save(raw=True)
+        self.assertTrue(isinstance(obj._id, ObjectId))
+        self.assertEqual(TestRawSaved.find_one(obj._id).name, 'first')
+
+        obj.name = 'changed'
+        obj.save(full=True, raw=True)
+        self.assertEqual(TestRawSaved.find_one(obj._id).name, 'changed')
+
+        result = TestRawSaved.save_many([TestRawSaved({'name': 'x'}), obj],
+                                        raw=True)
+        self.assertEqual((len(result.saved), result.errors), (2, []))
+        self.assertEqual(TestRawSaved.find().count(), 2)
+
+    def test_lazy_decode(self):
+        class TestLazyDecoded(Model):
+            name = StringField()
+            meta = DictField(blank=True)
+            tags = ListField(field=StringField(), blank=True)
+
+        data = {'name': 'a', 'meta': {'x': {'y': 1}}, 'tags': ['t']}
+        TestLazyDecoded(data).save()
+
+        obj = next(TestLazyDecoded.find().lazy_decode())
+        self.assertTrue(isinstance(obj._data, manga._RawData))
+        self.assertEqual(obj.name, 'a')
+        self.assertEqual(obj.meta, {'x': {'y': 1}})
+        self.assertEqual(type(obj.meta['x']), dict)
+
+        obj.meta['x']['y'] = 2
+        obj.name = 'b'
+        obj.save()
+
+        stored = TestLazyDecoded.find_one(obj._id)
+        self.assertEqual((stored.name, stored.meta, stored.tags),
+                         ('b', {'x': {'y': 2}}, ['t']))
+
+        TestLazyDecoded._lazy_decode = True
+        obj = TestLazyDecoded.find_one(obj._id)
+        self.assertTrue(isinstance(obj._data, manga._RawData))
+        self.assertEqual(obj.tags, ['t'])
+        self.assertEqual(dict(obj._data), dict(stored._data))
+
+    def test_incremental_validation(self):
+        calls = []
+
+        class CountedField(Field):
+            def validate(self, value):
+                calls.append(value)
+                super(CountedField, self).validate(value)
+
+        class TestIncremental(Model):
+            name = CountedField()
+            notes = CountedField(blank=True)
+            start = Field(blank=True)
+            end = Field(blank=True)
+
+            def clean(self):
+                if self.start and self.end and self.start > self.end:
+                    raise ValidationError('TestIncremental', 'end', self.end)
+
+        obj = TestIncremental({'name': 'a'})
+        self.assertEqual(calls, ['a'])
+
+        # Only the value left out when building it is validated.
+        obj.save()
+        self.assertEqual(calls, ['a', None])
+        obj.save()
+        self.assertEqual(calls, ['a', None])
+
+        obj.name = 'b'
+        obj.save()
+        self.assertEqual(calls, ['a', None, 'b'])
+
+        obj._data['notes'] = 'raw'
+        obj.save()
+        self.assertEqual(calls, ['a', None, 'b', 'raw'])
+        self.assertEqual(db.testincremental.find_one(obj._id)['notes'], 'raw')
+
+        # Loaded documents are validated in full the first time.
+        del calls[:]
+        loaded = TestIncremental.find_one(obj._id)
+        loaded.save()
+        self.assertEqual(calls, ['b', 'raw'])
+
+        obj.start, obj.end = 2, 1
+        self.assertRaises(ValidationError, obj.save)
+        obj.end = 3
+        obj.save()
+        self.assertEqual(TestIncremental.find_one(obj._id).end, 3)
+
+    def test_read_snapshots(self):
+        class TestSnapshot(Model):
+            items = ListField(blank=True)
+            meta = DictField(blank=True)
+
+        TestSnapshot({'items': [{'a': 1}], 'meta': {'k': [1, 2]}}).save()
+
+        for lazy in (False, True):
+            obj = next(TestSnapshot.find().lazy_decode(lazy))
+            obj.items, obj.meta
+            self.assertEqual(obj._changes(), {})
+
+            obj.items[0]['a'] = 2
+            obj.meta['k'].append(3)
+            obj._flush()
+            self.assertEqual(obj._changes(), {'$set': {'items': [{'a': 2}],
+                                                       'meta.k': [1, 2, 3]}})
+
+    def test_blank_document_field(self):
+        class TestBlankRect(Document):
+            v1 = Field(blank=True)
+
+        class TestBlankHolder(Model):
+            name = StringField()
+            rect = DocumentField(document=TestBlankRect, blank=True)
+
+        TestBlankHolder({'name': 'a'}).save()
+
+        # Reading the empty document made up for None doesn't store it.
+        y = TestBlankHolder.find_one()
+        self.assertEqual(y.rect.v1, None)
+        y.name = 'b'
+        y.save()
+        self.assertEqual(db.testblankholder.find_one()['rect'], None)
+
+        y.rect.v1 = 1
+        y.save()
+        self.assertEqual(db.testblankholder.find_one()['rect'], {'v1': 1})
 
 if __name__ == '__main__':
     unittest.main()